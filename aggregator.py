@@ -3,37 +3,273 @@
 
 import itertools
 import collections
+import operator
+import heapq
+import bisect
+import random
+import functools
+import multiprocessing
 import types
+import threading
+import Queue
+import timeit
 import csv
+import re
+import math
+import gzip
+import hashlib
+import mmap
+import struct
+import decimal
+import cPickle
 from cStringIO import StringIO
-from datetime import date
+from datetime import date, datetime, timedelta
 from _abcoll import Mapping
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 #################################################
 ## Classes
 
 Total = collections.namedtuple('Total', ['count','amount'])
+Ingested = collections.namedtuple('Ingested', ['rows','skipped'])
+MEASURES = ('count', 'sum', 'min', 'max', 'sumsq', 'mean', 'variance', 'stddev')
+
+class _AggregatorMixin(object):
+    '''Loading, export and fixed-point amounts shared by Aggregator and ColumnarAggregator,
+       built on their update_many, write_csv and _scale and _currency settings.
+    '''
+
+    def _currency_index(self):
+        if self._currency not in self._fields:
+            raise ValueError('a per-currency scale needs the currency field %r among the fields %s' % (self._currency, self._fields))
+        return self._fields.index(self._currency)
+
+    def _currency_places(self, currency):
+        '''Return the decimal places for a currency under a per-currency scale.'''
+        try:
+            return self._scale[currency]
+        except KeyError:
+            raise ValueError('no scale given for currency %r' % (currency,))
+
+    def _places(self, key):
+        '''Return the decimal places amounts for key are stored with in fixed-point mode.'''
+        if isinstance(self._scale, Mapping):
+            return self._currency_places(key[self._currency_index()])
+        return self._scale
+
+    def _sum_totals(self, key, *values):
+        '''sumTotals for key: in fixed-point mode, numbers are converted to minor units
+           and Totals must already hold integer minor units.
+        '''
+        if self._scale is None:
+            return sumTotals(*values)
+        count, amount = 0, 0
+        for value in values:
+            if isinstance(value, tuple):
+                if isinstance(value[1], float):
+                    raise TypeError('a fixed-point Total needs an amount in integer minor units, got %r' % (value,))
+                count += int(value[0])
+                amount += int(value[1])
+            else:
+                count += 1
+                amount += _minorUnits(value, self._places(key))
+        return Total(count, amount)
+
+    def decimal_amount(self, key):
+        '''Return the amount for key as a Decimal, exact in fixed-point mode.'''
+        key = tuple(key)
+        amount = self[key][1]
+        if self._scale is None:
+            return decimal.Decimal(repr(amount))
+        return self._decimal(key, amount)
+
+    def _decimal(self, key, units):
+        '''Return an amount in minor units for key as a Decimal in its currency's places.'''
+        return decimal.Decimal(units).scaleb(-self._places(key))
+
+    def _csv_rows(self, rows):
+        '''Pass (field values..., count, amount) rows through, rendering minor units as
+           decimals under a scale, so a csv amount always reads in whole currency units.
+        '''
+        if self._scale is None:
+            return rows
+        n = len(self._fields)
+        return (row[:n + 1] + (self._decimal(row[:n], row[n + 1]),) if row[n + 1] != '' else row for row in rows)
+
+    def getcsv(self, *sort_keys, **kwargs):
+        csv_fd = StringIO()
+        # leaving this open to **kwargs for passing in alternate dialects
+        self.write_csv(csv_fd, *sort_keys, **kwargs)
+        csv_fd.seek(0)
+        return csv_fd
+
+    def ingest_csv(self, fileobj, key_columns, amount_column, chunk_size=65536, **kwargs):
+        '''Stream transaction rows from a csv file object or path into the totals.
+
+        Columns are named (resolved against the header row) or given as indexes.
+        Rows are read in chunks of chunk_size, so memory stays constant however
+        large the file is; blank lines are passed over, and rows with missing
+        columns or unparseable amounts are skipped and counted. Extra keyword
+        arguments go to csv.reader. Returns an Ingested(rows, skipped) tuple, which
+        is Ingested(0, 0) for an empty file, header or not.
+        '''
+        return _ingestCsv(self, fileobj, key_columns, amount_column, chunk_size, kwargs)
+
+    @classmethod
+    def from_csv(cls, fileobj, key_columns, amount_column, fieldnames=None, chunk_size=65536, **kwargs):
+        '''Build a new object from a csv file; see ingest_csv.
+
+        :param: fieldnames: fields of the new object, defaulting to key_columns.
+        '''
+        result = cls(fieldnames or key_columns)
+        result.ingest_csv(fileobj, key_columns, amount_column, chunk_size, **kwargs)
+        return result
+
+    @classmethod
+    def from_csv_parallel(cls, paths, key_columns, amount_column, fieldnames=None, processes=None, **kwargs):
+        '''Build one object per csv path in a process pool and combine them; see from_csv.'''
+        build = functools.partial(_csvShard, cls, key_columns, amount_column, fieldnames, kwargs)
+        return parallelAggregate(paths, build, processes)
+
+    @classmethod
+    def from_rows_parallel(cls, chunks, fieldnames, processes=None):
+        '''Build one object per chunk of (field values..., amount) rows in a process pool and combine them.'''
+        return parallelAggregate(chunks, functools.partial(_rowsShard, cls, fieldnames), processes)
 
-class Aggregator(dict):
+
+class Aggregator(_AggregatorMixin, dict):
     # This class simplifies taking an aggregate count and volume from a list of financial transactions, supporting access to multiple views on the completed sums by sets of keys.
 	
     '''Create a miniature database-like object to quickly see totals for a given set of keys.
     
     :param: fieldnames: initial list of fields to use for labelling keys by their type.
+    :param: measures: keyword only; names from MEASURES to keep per key beyond the
+            count and amount Totals, accumulated in the same pass over each batch.
+    :param: scale: keyword only; store amounts as exact integer minor units with this
+            many decimal places, or a mapping of currency to places. Numbers are
+            converted as they are added (strings and Decimals exactly), Totals are
+            taken as already in minor units, and sums are integer additions.
+    :param: currency: keyword only; the field holding the currency for a per-currency scale.
     '''
 
     def __init__(self, fieldnames, *args, **kwargs):
+        measures = tuple(kwargs.pop('measures', ()))
+        self._scale = kwargs.pop('scale', None)
+        self._currency = kwargs.pop('currency', None)
         self._fields = tuple(fieldnames)
         self._keywrapper = collections.namedtuple('Key', fieldnames, **kwargs)
+        self._listeners = []  # callables taking (key, old total, new total) on every store
+        self._indexes = {}    # field -> value -> set of keys
+        self._cube = {}       # kept fields -> (key projection, collapsed Aggregator)
+        self._sort_cache = {} # (sort fields, reverse) -> sorted keys
+        self._top = None      # _RunningTop kept by track_top
+        self._dirty = None    # key -> Total at the last checkpoint (None if absent), kept by track_changes
+        self._trie = None     # [count, amount, value -> child node] over the keys in field order, kept by create_trie
+        self._sidecars = {}   # sketch name -> (sketch factory, key -> sketch, fed amounts)
+        self._measures = measures
+        if measures:
+            for measure in measures:
+                if measure not in MEASURES:
+                    raise ValueError('%r is not one of the measures %s' % (measure, MEASURES))
+            self._measurewrapper = collections.namedtuple('Measures', measures)
+            # Moments are fed by _accumulate itself, not as an amount-fed sketch
+            self._sidecars['measures'] = (Moments, {}, False)
         for key in args:
-            self[tuple(key)] = Total(0, 0.0)
+            self[tuple(key)] = Total(0, 0)
+
+    # Raw store access by trusted key tuple, bypassing validation and listeners.
+    # Subclasses storing keys in another form (EncodedAggregator) override these.
+    _lookup = dict.get
+    _store = dict.__setitem__
+    _discard = dict.__delitem__
+    _pairs = dict.iteritems
+    _extend = dict.update
+
+    def _derive(self, fields):
+        '''Return a new, empty object of the same kind over fields, with the same sketches.'''
+        result = self.__class__(fields, **self._config())
+        for name, (factory, sketches, amounts) in self._sidecars.iteritems():
+            result._sidecars[name] = (factory, {}, amounts)
+        return result
+
+    def _config(self):
+        '''Return the keyword arguments configuring this object beyond its fields.'''
+        return {'measures': self._measures, 'scale': self._scale, 'currency': self._currency}
+
+    def copy(self):
+        result = self._derive(self._fields)
+        result._extend(self._pairs())
+        result._merge_sidecars(self)
+        return result
 
     def __repr__(self):
         return '\n'.join('%s: %s' % (k,v) for k,v in self.iteritems())
 
     def __setitem__(self, key, value):
         key = tuple(self._keywrapper(*key)._asdict().values()) # fail if key can't match fields
-        super(Aggregator, self).__setitem__(key, sumTotals(value))
+        total = self._sum_totals(key, value)
+        self._put(key, total)
+        if self._measures:
+            # the key's transactions are replaced, so its summary starts again from the new value
+            summary = self._sidecars['measures'][1][key] = Moments()
+            if isinstance(value, tuple):
+                summary.add_summary(total[0], total[1], None, None, None)
+            else:
+                summary.add(total[1])
+
+    def __delitem__(self, key):
+        self._remove(tuple(key))
+
+    def _remove(self, key):
+        '''Remove a key tuple and its sketches, telling any listeners, and return its Total.'''
+        total = self[key]
+        self._discard(key)
+        for factory, sketches, amounts in self._sidecars.itervalues():
+            sketches.pop(key, None)
+        for listener in self._listeners:
+            listener(key, total, None)
+        return total
+
+    # the dict mutators below would bypass the listeners keeping indexes, views and the trie
+    def pop(self, key, *default):
+        key = tuple(key)
+        if default and key not in self:
+            return default[0]
+        return self._remove(key)
+
+    def popitem(self):
+        for key in self.iterkeys():
+            return self._keywrapper(*key), self._remove(key)
+        raise KeyError('popitem(): aggregator is empty')
+
+    def setdefault(self, key, default=Total(0, 0)):
+        key = tuple(key)
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        if self._listeners:
+            for key in self.keys():
+                self._remove(key)
+        else:
+            dict.clear(self)
+            for factory, sketches, amounts in self._sidecars.itervalues():
+                sketches.clear()
+
+    def _put(self, key, total):
+        '''Store a Total under a trusted key tuple, telling any listeners.'''
+        if self._listeners:
+            old = self._lookup(key)
+            self._store(key, total)
+            for listener in self._listeners:
+                listener(key, old, total)
+        else:
+            self._store(key, total)
 
     def __iadd__(self, other):
         self.update(other)
@@ -44,51 +280,238 @@ class Aggregator(dict):
             return NotImplemented
         if self._fields != other._fields:
             raise ValueError("Mismatch between fields!\n  Original: %s\n  Applying: %s\n" % (self._fields, other._fields))
-        result = Aggregator(self._fields)
-        for key, total in itertools.chain(*(o.iteritems() for o in (self, other))):
-            key = tuple(self._keywrapper(*key)._asdict().values()) # fail if key can't match fields
-            result.update({key: total})
+        _checkScales(self, other)
+        result = self.copy()
+        result._fold(other._pairs())
+        result._merge_sidecars(other)
         return result
 
+    def __reduce__(self):
+        # the namedtuple key class can't be pickled, so rebuild from the fields and raw store
+        return (_restoreAggregator, (self.__class__, self._fields, dict(self._pairs()), self._sidecars, self._config()))
+
     def update(self, *args, **kwargs):
         if args and len(args) > 1:
             raise TypeError('expected at most 1 arguments, got %d' % len(args))
         iterable = args[0] if args else None
         if iterable is not None:
-            if isinstance(iterable, Mapping):
+            if isinstance(iterable, (Aggregator, ColumnarAggregator)):
+                _checkScales(self, iterable)
+            if isinstance(iterable, ColumnarAggregator):
+                # the same totals held in columns: take them in dict form, measures and all
+                iterable = iterable.to_aggregator()
+            if isinstance(iterable, Aggregator) and iterable._fields == self._fields:
+                # same schema: keys are already valid and values already Totals
+                self._fold(iterable._pairs())
+                self._merge_sidecars(iterable)
+            elif isinstance(iterable, Mapping):
+                fed = self._amount_sketches() if self._sidecars else None
                 for k, v in iterable.iteritems():
                     key = tuple(self._keywrapper(*k)._asdict().values()) # fail if key can't match fields
-                    if self.get(key):
-                        self[key] = sumTotals(self[key], v)
-                    else:
-                        self[key] = sumTotals(v)
+                    added = self._sum_totals(key, v)
+                    current = self._lookup(key)
+                    self._put(key, Total(current[0] + added[0], current[1] + added[1]) if current else added)
+                    if isinstance(v, tuple):
+                        if self._measures:
+                            self._summarize_totals(((key, added),))
+                        continue
+                    # a single transaction: its amount also goes into amount-fed sketches
+                    if fed:
+                        for factory, sketches in fed:
+                            _feedSketches(factory, sketches, ((key, added[1]),))
+                    if self._measures:
+                        _feedSketches(Moments, self._sidecars['measures'][1], ((key, added[1]),))
             else:
                 raise TypeError('expected a mapping between keys and values, got %s' % type(iterable))
         if kwargs:
             self.update(kwargs)
 
+    def update_many(self, rows, chunk_size=65536):
+        '''Accumulate an iterable of (field values..., amount) tuples.
+
+        Row arity is checked once per chunk rather than per key, and amounts are
+        summed straight into the store without building a Total per row.
+        '''
+        n = len(self._fields)
+        getkey, getamount = _keyGetter(range(n)), operator.itemgetter(n)
+        for chunk in _chunks(rows, chunk_size):
+            if len(chunk[0]) != n + 1:
+                raise TypeError('expected rows of %d fields and an amount, got %d values' % (n, len(chunk[0])))
+            keys = map(getkey, chunk)
+            self._accumulate(keys, self._amounts(keys, map(getamount, chunk)))
+
+    def update_columns(self, columns, amounts, counts=None):
+        '''Accumulate parallel sequences: one per field, plus amounts and optional counts.'''
+        if len(columns) != len(self._fields):
+            raise TypeError('expected %d key columns, got %d' % (len(self._fields), len(columns)))
+        if any(len(column) != len(amounts) for column in columns) or counts is not None and len(counts) != len(amounts):
+            raise ValueError('key, amount and count columns differ in length')
+        keys = itertools.izip(*columns) if columns else itertools.repeat((), len(amounts))
+        if self._scale is None:
+            self._accumulate(keys, itertools.imap(float, amounts), counts)
+        else:
+            keys = list(keys)
+            self._accumulate(keys, self._amounts(keys, amounts), counts)
+
+    def _amounts(self, keys, amounts):
+        '''Convert a list of added amounts for keys to stored amounts: floats, or minor units in fixed-point mode.'''
+        if self._scale is None:
+            return map(float, amounts)
+        if isinstance(self._scale, Mapping):
+            index = self._currency_index()
+            places = dict((currency, self._currency_places(currency)) for currency in set(key[index] for key in keys))
+            return [_minorUnits(amount, places[key[index]]) for key, amount in itertools.izip(keys, amounts)]
+        return [_minorUnits(amount, self._scale) for amount in amounts]
+
+    @classmethod
+    def from_records(cls, records, key_fields, amount_field, fieldnames=None, chunk_size=65536):
+        '''Build an Aggregator from mappings or sequences, picking out key_fields and amount_field.
+
+        :param: fieldnames: fields of the new Aggregator, defaulting to key_fields.
+        '''
+        result = cls(fieldnames or key_fields)
+        _ingestRecords(result, records, key_fields, amount_field, chunk_size)
+        return result
+
+    def _accumulate(self, keys, amounts, counts=None):
+        '''Sum parallel iterables of trusted key tuples and float amounts into the store.'''
+        batch = {}
+        get = batch.get
+        fed = self._amount_sketches() if self._sidecars and counts is None else None
+        if fed:
+            # single transactions: their amounts also go into the amount-fed sketches
+            keys, amounts = list(keys), list(amounts)
+            for factory, sketches in fed:
+                _feedSketches(factory, sketches, itertools.izip(keys, amounts))
+        if counts is None and self._measures:
+            return self._accumulate_measures(keys, amounts)
+        if counts is None:
+            for key, amount in itertools.izip(keys, amounts):
+                running = get(key)
+                if running is None:
+                    batch[key] = [1, amount]
+                else:
+                    running[0] += 1
+                    running[1] += amount
+        else:
+            for key, amount, count in itertools.izip(keys, amounts, counts):
+                running = get(key)
+                if running is None:
+                    batch[key] = [int(count), amount]
+                else:
+                    running[0] += int(count)
+                    running[1] += amount
+            if self._measures:
+                self._summarize_totals(batch.iteritems())
+        self._fold(batch.iteritems())
+
+    def _accumulate_measures(self, keys, amounts):
+        '''As _accumulate, also merging a summary of each key's amounts in the batch into its Moments.'''
+        summaries = _summarizeBatch(keys, amounts)
+        moments = self._sidecars['measures'][1]
+        get = moments.get
+        for key, count, amount, low, high, m2 in summaries:
+            summary = get(key)
+            if summary is None:
+                summary = moments[key] = Moments()
+            summary.add_summary(count, amount, low, high, m2)
+        self._fold((summary[0], summary[1:3]) for summary in summaries)
+
+    def _summarize_totals(self, pairs):
+        '''Merge (key tuple, (count, amount)) pairs of pre-aggregated amounts into the keys' Moments,
+           which then no longer know their min, max or spread.
+        '''
+        moments = self._sidecars['measures'][1]
+        get = moments.get
+        for key, (count, amount) in pairs:
+            summary = get(key)
+            if summary is None:
+                summary = moments[key] = Moments()
+            summary.add_summary(count, amount, None, None, None)
+
+    def measures(self, key):
+        '''Return the configured measures for key as a Measures namedtuple.
+
+        Every measure comes from the key's Moments, which every write keeps in
+        step with its Total. Amounts added pre-aggregated (as Totals, with counts,
+        or from an aggregator keeping no measures) carry no spread, so after them
+        min, max, sumsq, variance and stddev are None.
+        '''
+        if not self._measures:
+            raise ValueError('no measures were configured')
+        key = tuple(key)
+        summary = self._sidecars['measures'][1].get(key)
+        if summary is None:
+            self[key]  # a key with no transactions yet, or a KeyError
+            summary = Moments()
+        values = _measureValues(summary.count, summary.total, summary.low, summary.high, summary.m2)
+        return self._measurewrapper(*[values[measure] for measure in self._measures])
+
+    def _fold(self, pairs):
+        '''Add (trusted key tuple, (count, amount)) pairs into the store.'''
+        get = self._lookup
+        store = self._put if self._listeners else self._store
+        for key, (count, amount) in pairs:
+            total = get(key)
+            store(key, Total(count, amount) if total is None else Total(total[0] + count, total[1] + amount))
+
     def merge(self, other):
         '''Put together two arbitrary aggregators, supplying None for fieldkey
            values where the fields don't match.'''
-        if not isinstance(other, Aggregator):
-            return NotImplemented
-        # Although we can't guarantee field order, this shouldn't matter to us.
-        fields = tuple(set(other._fields).union(set(self._fields)))
-        result = Aggregator(fields)
-        for key, total in itertools.chain(*(o.iteritems() for o in (self, other))):
-            result_key = list(None for i in fields)
-            for k in key:
-                result_key[fields.index(key._fields[key.index(k)])] = k
-            key = tuple(result_key)
-            result.update({key: total})
+        return Aggregator.merge_all(self, other)
+
+    @staticmethod
+    def merge_all(*aggregators):
+        '''Put together any number of aggregators with differing fields in one pass over each,
+           supplying None for fieldkey values an input lacks.
+
+        The result's fields are the union of the inputs' fields in order of first
+        appearance. Key remapping is compiled once per input schema into a plan of
+        positions, rather than worked out again for every key. ColumnarAggregators
+        are taken in their dict form.
+        '''
+        aggregators = [agg.to_aggregator() if isinstance(agg, ColumnarAggregator) else agg for agg in aggregators]
+        for agg in aggregators:
+            if not isinstance(agg, Aggregator):
+                raise TypeError('expected Aggregators to merge, got %s' % type(agg))
+        if not aggregators:
+            raise ValueError('nothing to merge')
+        for agg in aggregators[1:]:
+            _checkScales(aggregators[0], agg)
+        fields = []
+        for agg in aggregators:
+            fields.extend(f for f in agg._fields if f not in fields)
+        plans = {}
+        batch = {}
+        get = batch.get
+        for agg in aggregators:
+            remap = plans.get(agg._fields)
+            if remap is None:
+                # fields an input lacks read from a None padded onto the end of its keys
+                missing = len(agg._fields)
+                remap = plans[agg._fields] = _keyGetter(agg._fields.index(f) if f in agg._fields else missing for f in fields)
+            for key, (count, amount) in agg._pairs():
+                key = remap(key + (None,))
+                running = get(key)
+                if running is None:
+                    batch[key] = [count, amount]
+                else:
+                    running[0] += count
+                    running[1] += amount
+        result = aggregators[0]._derive(fields)
+        result._fold(batch.iteritems())
+        for agg in aggregators:
+            if agg._sidecars or result._measures:
+                remap = plans[agg._fields]
+                result._merge_sidecars(agg, lambda key: remap(key + (None,)))
         return result
 
     def iteritems(self):
-        for k, v in super(Aggregator, self).iteritems():
+        for k, v in self._pairs():
             yield self._keywrapper(*k), v
 
     def items(self):
-        return [(self._keywrapper(*k), v) for k, v in super(Aggregator, self).items()]
+        return [(self._keywrapper(*k), v) for k, v in self._pairs()]
 
     def iterfieldkeys(self, field):
         index = self._fields.index(field)
@@ -99,117 +522,2690 @@ class Aggregator(dict):
         index = self._fields.index(field)
         return set( fk[index] for fk in self.keys() )
 
-    def filter(self, *args):
-        filtered_copy = Aggregator(self._fields)
-        for k in args:
-            found = [key for key in self if k in key]
-            for key in found:
-                filtered_copy[key] = self[key]
+    def create_index(self, *fields):
+        '''Keep an inverted index (value -> set of keys) for each of fields, or all fields.
+
+        Indexes are kept up to date as keys are added, and let `filter` intersect
+        posting lists instead of scanning every key.
+        '''
+        for field in fields or self._fields:
+            index = self._fields.index(field)
+            postings = self._indexes[field] = {}
+            for key in self.iterkeys():
+                postings.setdefault(key[index], set()).add(key)
+        if self._indexes and self._maintain_indexes not in self._listeners:
+            self._listeners.append(self._maintain_indexes)
+
+    def drop_index(self, *fields):
+        for field in fields or self._fields:
+            self._indexes.pop(field, None)
+        if not self._indexes and self._maintain_indexes in self._listeners:
+            self._listeners.remove(self._maintain_indexes)
+
+    def _maintain_indexes(self, key, old, new):
+        if old is None:
+            for field, postings in self._indexes.iteritems():
+                postings.setdefault(key[self._fields.index(field)], set()).add(key)
+        elif new is None:
+            for field, postings in self._indexes.iteritems():
+                postings[key[self._fields.index(field)]].discard(key)
+
+    def _match_any(self, values):
+        '''Return the set of keys holding any of values in any field.'''
+        if len(self._indexes) == len(self._fields):
+            return set().union(*[postings[v] for postings in self._indexes.itervalues() for v in values if v in postings])
+        return set(key for key in self for k in values if k in key)
+
+    def _match_field(self, field, values):
+        '''Return the set of keys holding one of values in field.'''
+        index = self._fields.index(field)
+        values = set(values) if isinstance(values, (tuple, list, set, frozenset)) else set((values,))
+        postings = self._indexes.get(field)
+        if postings is None:
+            return set(key for key in self if key[index] in values)
+        if len(values) == 1:
+            return postings.get(next(iter(values)), set())
+        return set().union(*[postings[v] for v in values if v in postings])
+
+    def filter(self, *args, **kwargs):
+        '''Return a new Aggregator holding the keys which contain any of args in any field
+           and, for each field=value keyword, that value (or one of a tuple of values) in that field.
+        '''
+        filtered_copy = self._derive(self._fields)
+        get = self._lookup
+        matches = self._matching(args, kwargs)
+        for key in matches:
+            filtered_copy._put(key, get(key))
+        if self._sidecars:
+            filtered_copy._merge_sidecars(self, keys=matches)
         return filtered_copy
 
-    def collapse(self, collapse_field):
-        '''Remove a sub-key element and merge values lacking the key, returning a new Aggregator.'''
-        collapse_index = self._fields.index(collapse_field)
-        fields = list(self._fields)
-        fields.remove(collapse_field)
-        collapsed_copy = Aggregator(fields)
-        for key, value in self.iteritems():
-            key = list(key)
-            toss = key.pop(collapse_index)
-            key = tuple(key)
-            if collapsed_copy.get(key):
-                collapsed_copy[key] = sumTotals(collapsed_copy[key], value)
+    def _matching(self, args, kwargs):
+        '''Return the set of keys selected by filter arguments.'''
+        matches = []
+        if args:
+            matches.append(self._match_any(args))
+        for field, values in kwargs.iteritems():
+            matches.append(self._match_field(field, values))
+        matches.sort(key=len)
+        return matches[0].intersection(*matches[1:]) if matches else set()
+
+    def materialize(self, *grouping_sets):
+        '''Precompute and maintain collapsed views, one per grouping set of fields to keep.
+
+        With no grouping sets, every proper subset of the fields is materialized.
+        Views are updated incrementally as totals are stored, so `collapse` down to
+        a materialized set of fields is a copy of the view rather than a full pass.
+        '''
+        if not grouping_sets:
+            grouping_sets = [kept for size in xrange(len(self._fields))
+                                  for kept in itertools.combinations(self._fields, size)]
+        for kept in grouping_sets:
+            kept = (kept,) if isinstance(kept, basestring) else tuple(kept)
+            for field in kept:
+                if field not in self._fields:
+                    raise ValueError('%r is not one of the fields %s' % (field, self._fields))
+            kept = tuple(f for f in self._fields if f in kept)
+            collapsed = set(self._fields).difference(kept)
+            self._cube[kept] = (_keyGetter(self._fields.index(f) for f in kept), self._collapse_scan(collapsed))
+        if self._cube and self._maintain_cube not in self._listeners:
+            self._listeners.append(self._maintain_cube)
+
+    def dematerialize(self):
+        self._cube.clear()
+        if self._maintain_cube in self._listeners:
+            self._listeners.remove(self._maintain_cube)
+
+    def _maintain_cube(self, key, old, new):
+        count = (new[0] if new else 0) - (old[0] if old else 0)
+        amount = (new[1] if new else 0) - (old[1] if old else 0)
+        for project, view in self._cube.itervalues():
+            view_key = project(key)
+            total = view._lookup(view_key)
+            if total is None:
+                total = Total(count, amount)
+            else:
+                total = Total(total[0] + count, total[1] + amount)
+            # counts cancel exactly where float amounts may leave a residue
+            if new is None and total[0] == 0:
+                view._discard(view_key)
             else:
-                collapsed_copy[key] = sumTotals(value)
+                view._store(view_key, total)
+
+    def collapse(self, *collapse_fields):
+        '''Remove one or more sub-key elements and merge values lacking them, returning a new Aggregator.'''
+        for field in collapse_fields:
+            self._fields.index(field)
+        kept = tuple(f for f in self._fields if f not in collapse_fields)
+        if self._sidecars:
+            # materialized views hold totals only, so sketches have to be merged from the keys
+            return self._collapse_scan(collapse_fields)
+        if kept in self._cube:
+            return self._cube[kept][1].copy()
+        if self._trie is not None and collapse_fields and kept == self._fields[:len(kept)]:
+            # only trailing fields go: the trie's nodes at that depth already hold the subtotals
+            return self._rollup(len(kept))
+        # otherwise start from the smallest materialized view which still holds every kept field
+        views = [view for fields, (project, view) in self._cube.iteritems() if set(kept).issubset(fields)]
+        if views:
+            view = min(views, key=len)
+            return view._collapse_scan(set(view._fields).difference(kept))
+        return self._collapse_scan(collapse_fields)
+
+    def _collapse_scan(self, collapse_fields):
+        kept = [i for i, f in enumerate(self._fields) if f not in collapse_fields]
+        project = _keyGetter(kept)
+        collapsed_copy = self._derive([self._fields[i] for i in kept])
+        batch = {}
+        get = batch.get
+        for key, (count, amount) in self._pairs():
+            key = project(key)
+            running = get(key)
+            if running is None:
+                batch[key] = [count, amount]
+            else:
+                running[0] += count
+                running[1] += amount
+        collapsed_copy._fold(batch.iteritems())
+        collapsed_copy._merge_sidecars(self, project)
         return collapsed_copy
 
+    def add_sketch(self, name, factory, amounts=False):
+        '''Keep a sketch per key alongside the totals, built by calling factory().
+
+        Sketches must offer add(value), merge(other) and copy(); they are fed by
+        `observe` and merged along with the totals by collapse, filter, +, update,
+        merge_all and parallel builds. factory should be picklable (a class, or a
+        functools.partial of one) for sketches to survive pickling.
+
+        :param: amounts: also feed the sketch each transaction amount added by update,
+                update_many, update_columns (without counts), from_records and the
+                CSV loaders. Pre-aggregated Totals carry no single amounts to feed.
+        '''
+        if name not in self._sidecars:
+            self._sidecars[name] = (factory, {}, amounts)
+
+    def drop_sketch(self, name):
+        self._sidecars.pop(name, None)
+
+    def track_distinct(self, name, precision=12):
+        '''Keep a HyperLogLog distinct count per key, of 2**precision one-byte registers.'''
+        self.add_sketch(name, functools.partial(HyperLogLog, precision))
+
+    def track_quantiles(self, name='amounts', k=200):
+        '''Keep a KLL quantile sketch of transaction amounts per key, fed as they are added.'''
+        self.add_sketch(name, functools.partial(KLL, k), amounts=True)
+
+    def observe(self, name, rows, chunk_size=65536):
+        '''Feed an iterable of (field values..., value) tuples into the name sketches of their keys.
+
+        Totals are untouched, so transactions are typically observed as well as added.
+        '''
+        factory, sketches = self._sidecars[name][:2]
+        n = len(self._fields)
+        getkey, getvalue = _keyGetter(range(n)), operator.itemgetter(n)
+        for chunk in _chunks(rows, chunk_size):
+            if len(chunk[0]) != n + 1:
+                raise TypeError('expected rows of %d fields and a value, got %d values' % (n, len(chunk[0])))
+            _feedSketches(factory, sketches, itertools.izip(map(getkey, chunk), map(getvalue, chunk)))
+
+    def sketch(self, name, key):
+        '''Return the name sketch for key, or None if nothing was observed for it.'''
+        return self._sidecars[name][1].get(tuple(key))
+
+    def distinct(self, name, key):
+        '''Return the estimated number of distinct values observed for key by a track_distinct sketch.'''
+        sketch = self.sketch(name, key)
+        return 0 if sketch is None else len(sketch)
+
+    def quantile(self, key, q, name='amounts'):
+        '''Return the estimated q-quantile (0 to 1) of the amounts added for key, or None if none were.'''
+        sketch = self.sketch(name, key)
+        return None if sketch is None else sketch.quantile(q)
+
+    def _amount_sketches(self):
+        return [(factory, sketches) for factory, sketches, amounts in self._sidecars.itervalues() if amounts]
+
+    def _merge_sidecars(self, other, project=None, keys=None):
+        '''Merge other's sketches into ours, mapping keys through project, or only for keys.'''
+        for name, (factory, theirs, amounts) in other._sidecars.iteritems():
+            if name == 'measures' and not self._measures:
+                continue
+            ours = self._sidecars.setdefault(name, (factory, {}, amounts))[1]
+            if keys is not None:
+                theirs = dict((key, theirs[key]) for key in keys if key in theirs)
+            for key, sketch in theirs.iteritems():
+                if project is not None:
+                    key = project(key)
+                mine = ours.get(key)
+                if mine is None:
+                    ours[key] = sketch.copy()
+                else:
+                    mine.merge(sketch)
+        if self._measures and not other._measures:
+            # other kept no measures: its totals still count towards ours, with an unknown spread
+            pairs = other._pairs() if keys is None else ((key, other._lookup(key)) for key in keys)
+            if project is not None:
+                pairs = ((project(key), total) for key, total in pairs)
+            self._summarize_totals(pairs)
+
+    def create_trie(self):
+        '''Keep a prefix trie over the keys in field order, each node holding the running
+           subtotal of the keys beneath it.
+
+        Drill-downs (subtotal, children, under) and collapsing trailing fields (rollup,
+        or collapse when only trailing fields go) then cost time in proportion to
+        the answer rather than to the whole store. Subtotals are kept by adding
+        the change of every store, so with float amounts they may drift in the
+        last digits from a fresh sum.
+        '''
+        if self._trie is None:
+            self._trie = [0, 0, {}]
+            for key, total in self._pairs():
+                self._maintain_trie(key, None, total)
+            self._listeners.append(self._maintain_trie)
+
+    def drop_trie(self):
+        if self._trie is not None:
+            self._listeners.remove(self._maintain_trie)
+            self._trie = None
+
+    def _maintain_trie(self, key, old, new):
+        count = (new[0] if new else 0) - (old[0] if old else 0)
+        amount = (new[1] if new else 0) - (old[1] if old else 0)
+        node, path = self._trie, []
+        for value in key:
+            node[0] += count
+            node[1] += amount
+            children = node[2]
+            child = children.get(value)
+            if child is None:
+                child = children[value] = [0, 0, {}]
+            path.append((children, value))
+            node = child
+        node[0] += count
+        node[1] += amount
+        if new is None:
+            # prune the removed key's leaf, and any branches it leaves empty
+            for children, value in reversed(path):
+                if children[value][2]:
+                    break
+                del children[value]
+
+    def _trie_node(self, prefix):
+        if self._trie is None:
+            raise ValueError('no trie index; call create_trie first')
+        if len(prefix) > len(self._fields):
+            raise KeyError(prefix)
+        node = self._trie
+        for value in prefix:
+            node = node[2].get(value)
+            if node is None:
+                raise KeyError(prefix)
+        return node
+
+    def subtotal(self, *prefix):
+        '''Return the Total of every key starting with the prefix values, e.g. subtotal('EUR', 'de').'''
+        node = self._trie_node(prefix)
+        return Total(node[0], node[1])
+
+    def children(self, *prefix):
+        '''Return (next field value, Total) pairs one level below the prefix values, for drilling down.'''
+        return [(value, Total(child[0], child[1])) for value, child in self._trie_node(prefix)[2].iteritems()]
+
+    def under(self, *prefix):
+        '''Return a new Aggregator of the keys starting with the prefix values.'''
+        result = self._derive(self._fields)
+        try:
+            node = self._trie_node(prefix)
+        except KeyError:
+            return result
+        level = [(tuple(prefix), node)]
+        for depth in xrange(len(prefix), len(self._fields)):
+            level = [(key + (value,), child) for key, node in level for value, child in node[2].iteritems()]
+        keys = [key for key, node in level]
+        get = self._lookup
+        result._extend((key, get(key)) for key in keys)
+        result._merge_sidecars(self, keys=keys)
+        return result
+
+    def rollup(self, field):
+        '''Return a new Aggregator collapsing every field after field, read off the trie.'''
+        if self._trie is None:
+            raise ValueError('no trie index; call create_trie first')
+        return self._rollup(self._fields.index(field) + 1)
+
+    def _rollup(self, depth):
+        result = self._derive(self._fields[:depth])
+        level = [((), self._trie)] if len(self) else []
+        for i in xrange(depth):
+            level = [(key + (value,), child) for key, node in level for value, child in node[2].iteritems()]
+        result._extend((key, Total(node[0], node[1])) for key, node in level)
+        if self._sidecars:
+            result._merge_sidecars(self, _keyGetter(xrange(depth)))
+        return result
+
     def value_sorted(self, by_count=False, reverse=False):
         return sorted(self.iteritems(), key=lambda (k,v): (v.count, v.amount) if by_count else (v.amount, v.count), reverse=reverse)
 
+    def query(self):
+        '''Start a lazy Query over this Aggregator, e.g. agg.query().where(field1='EUR').group_by('field3').top(10).'''
+        return Query(self)
+
+    def top(self, k, by='amount', within=None):
+        '''Return the k (Key, Total) pairs with the largest amount (or count), largest first.
+
+        within is a mapping of filter keywords restricting the candidates. Uses a
+        bounded heap, or the running top kept by track_top when that covers the query.
+        '''
+        get = self._lookup
+        tracked = self._top
+        if not within and tracked is not None and tracked.by == by and k <= tracked.k:
+            if tracked.stale:
+                tracked.rebuild(self._pairs())
+            best = sorted(tracked.members.iteritems(), key=operator.itemgetter(1), reverse=True)[:k]
+            return [(self._keywrapper(*key), get(key)) for key, value in best]
+        return self._extremes(heapq.nlargest, k, by, within)
+
+    def bottom(self, k, by='amount', within=None):
+        '''Return the k (Key, Total) pairs with the smallest amount (or count), smallest first.'''
+        return self._extremes(heapq.nsmallest, k, by, within)
+
+    def _extremes(self, select, k, by, within):
+        sort_key = _totalSortKey(by)
+        if within:
+            get = self._lookup
+            items = ((key, get(key)) for key in self._matching((), within))
+        else:
+            items = self._pairs()
+        return [(self._keywrapper(*key), total) for key, total in select(k, items, key=lambda (key, total): sort_key(total))]
+
+    def track_top(self, k, by='amount'):
+        '''Keep the k largest keys by amount (or count) current as totals are stored.
+
+        Increases are applied as they happen; a decrease or removal of a tracked
+        key marks the running top stale, and the next `top` call rebuilds it.
+        '''
+        if k < 1:
+            raise ValueError('k must be at least 1, got %r' % (k,))
+        self.untrack_top()
+        self._top = _RunningTop(k, by)
+        self._listeners.append(self._top)
+
+    def untrack_top(self):
+        if self._top is not None:
+            self._listeners.remove(self._top)
+            self._top = None
+
+    def track_changes(self):
+        '''Start remembering which keys change, so `deltas` and the delta exports cover only those.
+
+        Each changed key keeps its total as of the last checkpoint, so a key which
+        changes back, or is added and then removed, drops out of the deltas.
+        '''
+        if self._dirty is None:
+            self._dirty = {}
+            self._listeners.append(self._mark_dirty)
+
+    def untrack_changes(self):
+        if self._dirty is not None:
+            self._listeners.remove(self._mark_dirty)
+            self._dirty = None
+
+    def _mark_dirty(self, key, old, new):
+        if key not in self._dirty:
+            self._dirty[key] = old
+
+    def deltas(self):
+        '''Return (Key, Total) pairs for the keys changed since the last checkpoint, with
+           None for the Total of a key since removed.
+        '''
+        if self._dirty is None:
+            raise ValueError('changes are not being tracked; call track_changes first')
+        get = self._lookup
+        result = []
+        for key, before in self._dirty.iteritems():
+            total = get(key)
+            if total != before:
+                result.append((self._keywrapper(*key), total))
+        return result
+
+    def checkpoint(self):
+        '''Return the deltas and start tracking afresh from the current totals.'''
+        changed = self.deltas()
+        self._dirty.clear()
+        return changed
+
     def field_sorted(self, *field_keys, **kwargs):
         r = kwargs.get('reverse') or False
-        return sorted(self.iteritems(), key=lambda (k,v): [self._keywrapper(*k)._asdict[fk] for fk in field_keys], reverse=r)
+        get = self._lookup
+        return [(self._keywrapper(*k), get(k)) for k in self._sort_order(field_keys, r)]
 
-    def getcsv(self, *sort_keys, **kwargs):
-        csv_fd = StringIO()
-        r = kwargs.pop('reverse') if kwargs.get('reverse') else False
-        # leaving this open to **kwargs for passing in alternate dialects
-        cw = csv.writer(csv_fd, **kwargs)
-        cw.writerow(self._fields + ('count', 'amount'))
-        for pair in self.field_sorted(*sort_keys, reverse=r):
-            # each row is a (Key, Total) pair.
-            cw.writerow([i._asdict.values() for i in pair])
-        csv_fd.seek(0)
-        return csv_fd
+    def _sort_order(self, field_keys, reverse):
+        '''Return the keys sorted by field_keys, cached until a key is added or removed.'''
+        order = self._sort_cache.get((field_keys, reverse))
+        if order is None:
+            project = _keyGetter(self._fields.index(f) for f in field_keys)
+            order = self._sort_cache[field_keys, reverse] = sorted(self.iterkeys(), key=project, reverse=reverse)
+            if self._invalidate_sort_cache not in self._listeners:
+                self._listeners.append(self._invalidate_sort_cache)
+        return order
 
+    def _invalidate_sort_cache(self, key, old, new):
+        if old is None or new is None:
+            self._sort_cache.clear()
 
-#################################################
-##                Functions
-#################################################
+    def write_csv(self, target, *sort_keys, **kwargs):
+        '''Write a header and one row per key to a file object or path, a row at a time.
 
-def sumTotals(*t):
-    count, amount = 0, 0.0
-    for total in t:
-        if isinstance(total, (int, float)):
-            count += 1
-            amount += float(total)
+        With no sort_keys the rows come straight out of the store; otherwise they
+        follow a cached sort on those fields. Paths ending in .gz, or compress=True,
+        give gzip output. Remaining keyword arguments go to csv.writer. Under a
+        scale, amounts are written as decimals in each key's places, not minor units.
+        '''
+        reverse = kwargs.pop('reverse', False)
+        compress = kwargs.pop('compress', False)
+        if sort_keys:
+            get = self._lookup
+            rows = (key + get(key) for key in self._sort_order(sort_keys, reverse))
         else:
-            count += int(total[0])
-            amount += float(total[1])
-    return Total(count, amount)
+            rows = (key + total for key, total in self._pairs())
+        _writeCsv(target, self._fields + ('count', 'amount'), self._csv_rows(rows), compress, kwargs)
 
+    def write_deltas(self, target, **kwargs):
+        '''Write the deltas as write_csv does, one row per changed key, with empty count and
+           amount for a removed key, then checkpoint unless checkpoint=False.
 
-def getComplexCountFromSqlQuery(query, cursor, keylist):
-    SqlMap = collections.Counter()
-    cursor.execute(query)
-    key_indices = dict( (cursor.fieldnames().index(k), k) for k in keylist)
-    for row in cursor.fetchall():
-        count = None
-        key = keylist[:]
-        for i, value in enumerate(row):
-            if i in key_indices:
-                key[keylist.index(key_indices[i])] = value
-                continue
-            count = int(value) if type(value) in (int,long) or (type(value) in (str,unicode) and value.isdigit()) else float(value)
-        SqlMap[tuple(key)] = count
-    return SqlMap
+        The checkpoint follows a successful write, so a failed export loses no changes.
+        '''
+        checkpoint = kwargs.pop('checkpoint', True)
+        compress = kwargs.pop('compress', False)
+        changed = self.deltas()
+        rows = (tuple(key) + (tuple(total) if total is not None else ('', '')) for key, total in changed)
+        _writeCsv(target, self._fields + ('count', 'amount'), self._csv_rows(rows), compress, kwargs)
+        if checkpoint:
+            self._dirty.clear()
 
-def getSetDictFromSqlQuery(query, cursor, keylist):
-    SqlMap = dict()
-    cursor.execute(query)
-    key_indices = dict( (cursor.fieldnames().index(k), k) for k in keylist)
-    for row in cursor.fetchall():
-        item = None
-        key = keylist[:]
-        for i, value in enumerate(row):
-            if i in key_indices:
-                key[keylist.index(key_indices[i])] = value
-                continue
-            item = set([value]) if type(value) is not set else value
-        if not SqlMap.get(tuple(key)):
-            SqlMap[tuple(key)] = item
+    def save_deltas(self, path, checkpoint=True):
+        '''Write the changed keys as a binary snapshot (see save), a removed key as a zero Total,
+           then checkpoint unless checkpoint=False.
+        '''
+        changed = self._derive(self._fields)
+        changed._extend((tuple(key), total or Total(0, 0)) for key, total in self.deltas())
+        changed.save(path)
+        if checkpoint:
+            self._dirty.clear()
+
+    def save(self, path):
+        '''Write a binary snapshot: a pickled header of fields, per-field value dictionaries
+           and settings, then int32 code columns, int64 counts, float64 amounts (int64 minor
+           units under a scale) and, with measures, float64 min, max and m2 columns.
+        '''
+        if numpy is None:
+            raise ImportError('Aggregator snapshots require numpy')
+        n = len(self)
+        pairs = list(self._pairs())
+        values, columns = [], []
+        for column in (zip(*[key for key, total in pairs]) if n else [() for f in self._fields]):
+            column_values = list(set(column))
+            codes = dict((v, i) for i, v in enumerate(column_values))
+            values.append(column_values)
+            columns.append(numpy.array(map(codes.__getitem__, column), dtype=numpy.int32))
+        count = numpy.fromiter((t[0] for key, t in pairs), dtype=numpy.int64, count=n)
+        amount = numpy.fromiter((t[1] for key, t in pairs), dtype=numpy.float64 if self._scale is None else numpy.int64, count=n)
+        moments = None
+        if self._measures:
+            summaries = self._sidecars['measures'][1]
+            moments = [numpy.array(m, dtype=numpy.float64) for m in zip(*[_momentRow(summaries.get(key)) for key, total in pairs]) or [(), (), ()]]
+        # rows go out in code order, which is what ColumnarAggregator.load expects
+        columns, count, amount, moments = _groupColumns(columns, count, amount, moments)
+        _saveSnapshot(path, self._fields, values, columns, count, amount, self._config(), moments)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''Read a snapshot written by save into a new Aggregator.
+
+        The arrays are read through a memory mapping when mmap is set; use
+        ColumnarAggregator.load to keep them mapped instead of building the dict.
+        '''
+        fields, values, columns, count, amount, config, moments = _loadSnapshot(path, mmap)
+        result = cls(fields, **config)
+        keys = zip(*[map(v.__getitem__, c.tolist()) for v, c in zip(values, columns)]) if fields else [()] * len(count)
+        pairs = zip(keys, itertools.imap(Total, count.tolist(), amount.tolist()))
+        result._extend(pairs)
+        if result._measures:
+            _fillMoments(result._sidecars['measures'][1], pairs, moments or _unknownMoments(count))
+        return result
+
+
+class EncodedAggregator(Aggregator):
+    # Aggregator whose store holds each key as a single integer packing per-field value codes.
+
+    '''Create an Aggregator which interns each field's values into small integer codes.
+
+    Every distinct field value is held once in a per-field dictionary, and each
+    key is stored as one integer packing its codes, so the store hashes and
+    compares small integers instead of tuples of strings. Keys are decoded back
+    to tuples only as they are read out (iteritems, items, getcsv and so on).
+    CPython copies a dict subclass's raw entries in dict(e) and dict.update, so
+    those see packed codes; use dict(e.iteritems()) or e.copy() instead.
+
+    :param: fieldnames: initial list of fields to use for labelling keys by their type.
+    '''
+
+    _initial_bits = 8
+
+    def __init__(self, fieldnames, *args, **kwargs):
+        fieldnames = tuple(fieldnames)
+        self._values = [[] for f in fieldnames]  # per field: code -> value
+        self._codes = [{} for f in fieldnames]   # per field: value -> code
+        self._bits = [self._initial_bits for f in fieldnames]
+        self._layout()
+        Aggregator.__init__(self, fieldnames, *args, **kwargs)
+
+    def _layout(self):
+        self._shifts = [sum(self._bits[:i]) for i in xrange(len(self._bits))]
+        self._masks = [(1 << bits) - 1 for bits in self._bits]
+
+    def _pack(self, key):
+        '''Return the packed code for key, interning any new field values.'''
+        codes = map(dict.get, self._codes, key)
+        if None in codes:
+            codes = [self._intern(i, v) if c is None else c for i, (c, v) in enumerate(zip(codes, key))]
+        # codes occupy disjoint bits, so summing the shifted codes packs them
+        return sum(map(operator.lshift, codes, self._shifts))
+
+    def _find(self, key):
+        '''Return the packed code for key, or None if any of its values is unknown.'''
+        codes = map(dict.get, self._codes, key)
+        if None in codes:
+            return None
+        return sum(map(operator.lshift, codes, self._shifts))
+
+    def _unpack(self, packed):
+        return tuple(map(list.__getitem__, self._values, map(operator.and_, map(packed.__rshift__, self._shifts), self._masks)))
+
+    def _intern(self, index, value):
+        code = self._codes[index][value] = len(self._values[index])
+        self._values[index].append(value)
+        if code > self._masks[index]:
+            # the field has outgrown its code width: widen it and repack every stored key
+            pairs = list(self._pairs())
+            self._bits[index] *= 2
+            self._layout()
+            dict.clear(self)
+            self._extend(pairs)
+        return code
+
+    def _fold(self, pairs):
+        if self._listeners:
+            return Aggregator._fold(self, pairs)
+        # pack each key once for both the lookup and the store
+        get, store, pack = dict.get, dict.__setitem__, self._pack
+        for key, (count, amount) in pairs:
+            packed = pack(key)
+            total = get(self, packed)
+            store(self, packed, Total(count, amount) if total is None else Total(total[0] + count, total[1] + amount))
+
+    def _lookup(self, key, default=None):
+        packed = self._find(key)
+        return default if packed is None else dict.get(self, packed, default)
+
+    def _store(self, key, total):
+        dict.__setitem__(self, self._pack(key), total)
+
+    def _discard(self, key):
+        packed = self._find(key)
+        if packed is None:
+            raise KeyError(key)
+        dict.__delitem__(self, packed)
+
+    def _pairs(self):
+        unpack = self._unpack
+        for packed, total in dict.iteritems(self):
+            yield unpack(packed), total
+
+    def _extend(self, pairs):
+        store = dict.__setitem__
+        for key, total in pairs:
+            store(self, self._pack(key), total)
+
+    def copy(self):
+        result = self._derive(self._fields)
+        result._values = [list(values) for values in self._values]
+        result._codes = [dict(codes) for codes in self._codes]
+        result._bits = list(self._bits)
+        result._layout()
+        dict.update(result, self)
+        result._merge_sidecars(self)
+        return result
+
+    def __getitem__(self, key):
+        total = self._lookup(key)
+        if total is None:
+            raise KeyError(key)
+        return total
+
+    def get(self, key, default=None):
+        return self._lookup(key, default)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    has_key = __contains__
+
+    def iterkeys(self):
+        unpack = self._unpack
+        for packed in dict.iterkeys(self):
+            yield unpack(packed)
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def viewkeys(self):
+        return collections.KeysView(self)
+
+    def viewitems(self):
+        return collections.ItemsView(self)
+
+    def __eq__(self, other):
+        # packed codes depend on the order values were interned in, so compare decoded keys
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        get = other._lookup if isinstance(other, Aggregator) else other.get
+        return all(get(key) == total for key, total in self._pairs())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+
+class _RunningTop(object):
+    '''The k largest keys of an Aggregator by one total, kept current from store events.'''
+
+    def __init__(self, k, by):
+        self.k, self.by = k, by
+        self.sort_key = _totalSortKey(by)
+        self.members = {}  # key -> sort value
+        self.heap = []     # (sort value, key), lazily holding outdated entries
+        self.stale = True
+
+    def rebuild(self, items):
+        sort_key = self.sort_key
+        best = heapq.nlargest(self.k, items, key=lambda (key, total): sort_key(total))
+        self.members = dict((key, sort_key(total)) for key, total in best)
+        self._reheap()
+        self.stale = False
+
+    def _reheap(self):
+        self.heap = [(value, key) for key, value in self.members.iteritems()]
+        heapq.heapify(self.heap)
+
+    def __call__(self, key, old, new):
+        if self.stale:
+            return
+        members = self.members
+        current = members.get(key)
+        if new is None:
+            self.stale = current is not None
+            return
+        value = self.sort_key(new)
+        if current is not None:
+            if value < current:
+                self.stale = True
+            elif value > current:
+                members[key] = value
+                heapq.heappush(self.heap, (value, key))
+                if len(self.heap) > 4 * self.k + 64:
+                    self._reheap()
+        elif len(members) < self.k:
+            members[key] = value
+            heapq.heappush(self.heap, (value, key))
         else:
-            SqlMap[tuple(key)].update(item)
-    return SqlMap
+            heap = self.heap
+            while members.get(heap[0][1]) != heap[0][0]:
+                heapq.heappop(heap)
+            if value > heap[0][0]:
+                del members[heap[0][1]]
+                members[key] = value
+                heapq.heapreplace(heap, (value, key))
 
-def getAggregatesFromSqlQuery(query, cursor, keylist):
-    SqlMap = Aggregator(keylist)
-    cursor.execute(query)
-    key_indices = dict( (cursor.fieldnames().index(k), k) for k in keylist)
-    for row in cursor.fetchall():
-        count, amount = None, None
-        key = keylist[:]
-        for i, value in enumerate(row):
-            if i in key_indices:
-                key[keylist.index(key_indices[i])] = value
-                continue
-            # assume count is followed by amount, always
-            if count:
-                amount = float(value)
+
+class Query(object):
+    '''A lazy plan of filters and a grouping over an Aggregator, run as one pass over its store.
+
+    where and group_by only record steps, each returning a new Query. The terminal
+    methods (run, items, top, bottom, value_sorted) filter and group every key in a
+    single pass, summing into plain lists, and wrap keys in namedtuples only for the
+    rows they return, instead of building an Aggregator at every step.
+    '''
+
+    def __init__(self, source, any_of=(), allowed=None, group=None):
+        self._source = source
+        self._any_of = tuple(any_of)    # per where() call: values of which a key must hold one, in any field
+        self._allowed = allowed or {}   # field -> frozenset of values it may hold
+        self._group = group             # fields kept, or None for all of them
+
+    def where(self, *args, **kwargs):
+        '''Keep keys holding any of args in any field and, for each field=value keyword, that
+           value (or one of a tuple of values) in that field, as for Aggregator.filter.
+           Successive calls narrow the selection further.
+        '''
+        allowed = dict(self._allowed)
+        for field, values in kwargs.iteritems():
+            self._source._fields.index(field)
+            values = frozenset(values) if isinstance(values, (tuple, list, set, frozenset)) else frozenset((values,))
+            allowed[field] = allowed[field] & values if field in allowed else values
+        any_of = self._any_of + (frozenset(args),) if args else self._any_of
+        return Query(self._source, any_of, allowed, self._group)
+
+    def group_by(self, *fields):
+        '''Keep only fields, in that order, summing the totals of keys which then coincide.'''
+        available = self._source._fields if self._group is None else self._group
+        for field in fields:
+            if field not in available:
+                raise ValueError('%r is not one of the fields %s' % (field, available))
+        return Query(self._source, self._any_of, self._allowed, tuple(fields))
+
+    def _selected(self):
+        '''Yield the (key, total) pairs of the source which pass every filter.'''
+        source = self._source
+        if not self._any_of and not self._allowed:
+            return source._pairs()
+        if source._indexes:
+            # let the inverted indexes narrow the candidates before checking what they don't cover
+            get = source._lookup
+            candidates = source._matching(self._any_of[:1] and tuple(self._any_of[0]), self._allowed)
+            pairs = ((key, get(key)) for key in candidates)
+        else:
+            pairs = source._pairs()
+        fields = list(self._allowed)
+        project = _keyGetter(source._fields.index(field) for field in fields)
+        allowed = [self._allowed[field] for field in fields]
+        if reduce(operator.mul, map(len, allowed), 1) <= 4096:
+            # few enough combinations to test the projected key against all of them at once
+            combinations = set(itertools.product(*allowed))
+            permitted = lambda key: project(key) in combinations
+        else:
+            permitted = lambda key: all(itertools.imap(frozenset.__contains__, allowed, project(key)))
+        any_of = self._any_of
+        if not any_of:
+            return ((key, total) for key, total in pairs if permitted(key))
+        return ((key, total) for key, total in pairs
+                if permitted(key) and all(not values.isdisjoint(key) for values in any_of))
+
+    def _totals(self):
+        '''Return the fields of the result and an iterable of its (key tuple, (count, amount)) pairs.'''
+        source = self._source
+        if self._group is None or self._group == source._fields:
+            return source._fields, self._selected()
+        project = _keyGetter(source._fields.index(field) for field in self._group)
+        batch = {}
+        get = batch.get
+        for key, (count, amount) in self._selected():
+            key = project(key)
+            running = get(key)
+            if running is None:
+                batch[key] = [count, amount]
             else:
-                count = int(value)
-        SqlMap[tuple(key)] = Total(count, amount)
-    return SqlMap
+                running[0] += count
+                running[1] += amount
+        return self._group, batch.iteritems()
+
+    def _wrap(self, fields, pairs):
+        wrapper = self._source._keywrapper if fields == self._source._fields else collections.namedtuple('Key', fields)
+        return [(wrapper(*key), Total(*total)) for key, total in pairs]
+
+    def run(self):
+        '''Return the result as a new Aggregator, with any sketches merged along.'''
+        source = self._source
+        fields, pairs = self._totals()
+        result = source._derive(fields)
+        result._fold(pairs)
+        if source._sidecars:
+            project = _keyGetter(source._fields.index(field) for field in fields)
+            result._merge_sidecars(source, project, keys=[key for key, total in self._selected()])
+        return result
+
+    def items(self):
+        return self._wrap(*self._totals())
+
+    def top(self, k, by='amount'):
+        '''Return the k (Key, Total) pairs with the largest amount (or count), largest first.'''
+        return self._extremes(heapq.nlargest, k, by)
+
+    def bottom(self, k, by='amount'):
+        '''Return the k (Key, Total) pairs with the smallest amount (or count), smallest first.'''
+        return self._extremes(heapq.nsmallest, k, by)
+
+    def _extremes(self, select, k, by):
+        sort_key = _totalSortKey(by)
+        fields, pairs = self._totals()
+        return self._wrap(fields, select(k, pairs, key=lambda (key, total): sort_key(total)))
+
+    def value_sorted(self, by_count=False, reverse=False):
+        sort_key = _totalSortKey('count' if by_count else 'amount')
+        fields, pairs = self._totals()
+        return self._wrap(fields, sorted(pairs, key=lambda (key, total): sort_key(total), reverse=reverse))
+
+
+class ColumnarAggregator(_AggregatorMixin):
+    # Same surface as Aggregator, but each key field is held as a column of integer codes into a per-field dictionary, and count and amount as contiguous int64/float64 arrays.
+
+    '''Create an Aggregator-like object backed by numpy columns instead of a dict of Totals.
+
+    Rows are appended as they arrive and grouped lazily, so repeated keys cost
+    nothing until the object is read. `filter` and `collapse` run as boolean
+    masks and sort-based group-bys over the columns.
+
+    :param: fieldnames: initial list of fields to use for labelling keys by their type.
+    :param: measures: keyword only; names from MEASURES to keep per key, as for
+            Aggregator. Min, max and m2 are kept as three more float64 columns,
+            with nan where pre-aggregated amounts left them unknown.
+    :param: scale: keyword only; hold amounts as int64 minor units with this many
+            decimal places, or a mapping of currency to places, as for Aggregator.
+    :param: currency: keyword only; the field holding the currency for a per-currency scale.
+    '''
+
+    _initial_capacity = 1024
+
+    def __init__(self, fieldnames, *args, **kwargs):
+        if numpy is None:
+            raise ImportError('ColumnarAggregator requires numpy')
+        self._measures = tuple(kwargs.pop('measures', ()))
+        for measure in self._measures:
+            if measure not in MEASURES:
+                raise ValueError('%r is not one of the measures %s' % (measure, MEASURES))
+        if self._measures:
+            self._measurewrapper = collections.namedtuple('Measures', self._measures)
+        self._scale = kwargs.pop('scale', None)
+        self._currency = kwargs.pop('currency', None)
+        self._fields = tuple(fieldnames)
+        self._keywrapper = collections.namedtuple('Key', fieldnames, **kwargs)
+        self._values = [[] for f in self._fields]   # per field: code -> value
+        self._codes = [{} for f in self._fields]    # per field: value -> code
+        self._allocate(self._initial_capacity)
+        self._size = 0     # rows in use
+        self._grouped = 0  # leading rows which are sorted and hold unique keys
+        if args:
+            self.update(dict((tuple(key), Total(0, 0)) for key in args))
+
+    def _allocate(self, capacity):
+        self._columns = [numpy.zeros(capacity, dtype=numpy.int32) for f in self._fields]
+        self._count = numpy.zeros(capacity, dtype=numpy.int64)
+        self._amount = numpy.zeros(capacity, dtype=numpy.float64 if self._scale is None else numpy.int64)
+        # low, high and m2 per row, when measures are kept
+        self._moments = [numpy.zeros(capacity, dtype=numpy.float64) for m in range(3)] if self._measures else None
+
+    def _config(self):
+        '''Return the keyword arguments configuring this object beyond its fields.'''
+        return {'measures': self._measures, 'scale': self._scale, 'currency': self._currency}
+
+    def _spawn(self, fields, columns, count, amount, moments=None):
+        '''Build a new grouped ColumnarAggregator sharing this one's value dictionaries.'''
+        result = ColumnarAggregator(fields, **self._config())
+        for i, field in enumerate(fields):
+            source = self._fields.index(field)
+            result._values[i] = list(self._values[source])
+            result._codes[i] = dict(self._codes[source])
+        result._columns, result._count, result._amount = list(columns), count, amount
+        if result._moments is not None:
+            result._moments = list(moments)
+        result._size = result._grouped = len(count)
+        return result
+
+    def _momentRows(self):
+        '''Return the (low, high, m2) columns of the rows in use, or None without measures.'''
+        if self._moments is None:
+            return None
+        return [m[:self._size] for m in self._moments]
+
+    def copy(self):
+        self._compact()
+        n = self._size
+        moments = self._momentRows()
+        return self._spawn(self._fields, [c[:n].copy() for c in self._columns], self._count[:n].copy(), self._amount[:n].copy(),
+                           moments and [m.copy() for m in moments])
+
+    def _encode(self, index, value):
+        code = self._codes[index].get(value)
+        if code is None:
+            code = self._codes[index][value] = len(self._values[index])
+            self._values[index].append(value)
+        return code
+
+    def _append(self, columns, count, amount, moments=None):
+        '''Append encoded rows, growing the arrays geometrically. moments gives each row's
+           (low, high, m2) columns; without them the rows are taken as pre-aggregated.
+        '''
+        n = len(count)
+        if not n:
+            return
+        needed = self._size + n
+        if needed > len(self._count):
+            capacity = max(needed, 2 * len(self._count))
+            old = self._columns, self._count, self._amount, self._moments
+            self._allocate(capacity)
+            for new_column, old_column in zip(self._columns, old[0]):
+                new_column[:self._size] = old_column[:self._size]
+            self._count[:self._size] = old[1][:self._size]
+            self._amount[:self._size] = old[2][:self._size]
+            for new_column, old_column in zip(self._moments or (), old[3] or ()):
+                new_column[:self._size] = old_column[:self._size]
+        for column, codes in zip(self._columns, columns):
+            column[self._size:needed] = codes
+        self._count[self._size:needed] = count
+        self._amount[self._size:needed] = amount
+        if self._moments is not None:
+            if moments is None:
+                moments = _unknownMoments(self._count[self._size:needed])
+            for column, values in zip(self._moments, moments):
+                column[self._size:needed] = values
+        self._size = needed
+        # keep pending rows bounded by the size of the grouped part
+        if self._size - self._grouped > max(self._grouped, 65536):
+            self._compact()
+
+    def _compact(self):
+        '''Group all pending rows into the sorted, unique-keyed part of the arrays.'''
+        if self._grouped == self._size:
+            return
+        n = self._size
+        columns, count, amount, moments = _groupColumns([c[:n] for c in self._columns], self._count[:n], self._amount[:n],
+                                                         self._momentRows())
+        self._columns, self._count, self._amount, self._moments = columns, count, amount, moments
+        self._size = self._grouped = len(count)
+
+    def _locate(self, key):
+        '''Return the row index holding key, or None.'''
+        self._compact()
+        lo, hi = 0, self._size
+        for index, value in enumerate(key):
+            code = self._codes[index].get(value)
+            if code is None:
+                return None
+            section = self._columns[index][lo:hi]
+            lo, hi = lo + numpy.searchsorted(section, code, 'left'), lo + numpy.searchsorted(section, code, 'right')
+            if lo == hi:
+                return None
+        return lo if hi > lo else None
+
+    def __len__(self):
+        self._compact()
+        return self._size
+
+    def __repr__(self):
+        return '\n'.join('%s: %s' % (k,v) for k,v in self.iteritems())
+
+    def __contains__(self, key):
+        return self._locate(tuple(key)) is not None
+
+    def __getitem__(self, key):
+        row = self._locate(tuple(key))
+        if row is None:
+            raise KeyError(key)
+        # item() keeps minor units as ints
+        return Total(int(self._count[row]), self._amount[row].item())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        row = self._locate(tuple(self._keywrapper(*key))) # fail if key can't match fields
+        if row is None:
+            self.update({key: value})
+        else:
+            total = self._sum_totals(tuple(key), value)
+            if not self._count.flags.writeable:
+                # still backed by a read-only snapshot mapping; copy before the first write
+                self._count, self._amount = self._count.copy(), self._amount.copy()
+                if self._moments is not None:
+                    self._moments = [m.copy() for m in self._moments]
+            self._count[row], self._amount[row] = total.count, total.amount
+            if self._moments is not None:
+                # the key's transactions are replaced, so its moments start again from the new value
+                if not isinstance(value, tuple):
+                    moments = total.amount, total.amount, 0.0
+                else:
+                    moments = (numpy.nan,) * 3 if total.count else _momentRow(None)
+                for column, moment in zip(self._moments, moments):
+                    column[row] = moment
+
+    def measures(self, key):
+        '''Return the configured measures for key as a Measures namedtuple; see Aggregator.measures.'''
+        if not self._measures:
+            raise ValueError('no measures were configured')
+        row = self._locate(tuple(key))
+        if row is None:
+            raise KeyError(key)
+        # inf (no rows) and nan (pre-aggregated rows) both read as unknown
+        low, high, m2 = [float(m[row]) if numpy.isfinite(m[row]) else None for m in self._moments]
+        values = _measureValues(int(self._count[row]), self._amount[row].item(), low, high, m2)
+        return self._measurewrapper(*[values[measure] for measure in self._measures])
+
+    def __iadd__(self, other):
+        self.update(other)
+        return self
+
+    def __reduce__(self):
+        self._compact()
+        n = self._size
+        return (_restoreColumnar, (self._fields, self._values, [c[:n] for c in self._columns], self._count[:n], self._amount[:n],
+                                   self._config(), self._momentRows()))
+
+    def __add__(self, other):
+        if not isinstance(other, (Aggregator, ColumnarAggregator)):
+            return NotImplemented
+        if self._fields != other._fields:
+            raise ValueError("Mismatch between fields!\n  Original: %s\n  Applying: %s\n" % (self._fields, other._fields))
+        result = ColumnarAggregator(self._fields, **self._config())
+        result.update(self)
+        result.update(other)
+        return result
+
+    def __radd__(self, other):
+        # Aggregator + ColumnarAggregator lands here, since Aggregator.__add__ only takes Aggregators
+        return self.__add__(other)
+
+    def merge(self, other):
+        '''Put together two arbitrary aggregators, supplying None for fieldkey
+           values where the fields don't match; see Aggregator.merge_all.'''
+        if not isinstance(other, (Aggregator, ColumnarAggregator)):
+            raise TypeError('expected an aggregator to merge, got %s' % type(other))
+        _checkScales(self, other)
+        result = ColumnarAggregator(self._fields + tuple(f for f in other._fields if f not in self._fields), **self._config())
+        result._absorb(self)
+        result._absorb(other)
+        return result
+
+    def _absorb(self, source):
+        '''Append the keys of an Aggregator or ColumnarAggregator whose fields are among ours,
+           supplying None for the fields it lacks.
+        '''
+        if isinstance(source, ColumnarAggregator):
+            source._compact()
+            n = source._size
+            columns = []
+            for index, field in enumerate(self._fields):
+                if field not in source._fields:
+                    columns.append(numpy.repeat(numpy.int32(self._encode(index, None)), n))
+                    continue
+                # translate the other object's codes into ours, one lookup per distinct value
+                theirs = source._fields.index(field)
+                translate = numpy.array([self._encode(index, v) for v in source._values[theirs]], dtype=numpy.int32)
+                column = source._columns[theirs][:n]
+                columns.append(translate[column] if len(translate) else column)
+            self._append(columns, source._count[:n], source._amount[:n], source._momentRows())
+        else:
+            pairs = list(source._pairs())
+            missing = len(source._fields)
+            project = _keyGetter(source._fields.index(f) if f in source._fields else missing for f in self._fields)
+            columns = zip(*[project(key + (None,)) for key, total in pairs]) or [() for f in self._fields]
+            moments = None
+            if self._measures and source._measures:
+                summaries = source._sidecars['measures'][1]
+                moments = zip(*[_momentRow(summaries.get(key)) for key, total in pairs]) or [(), (), ()]
+            self._append([self._encodeColumn(i, column) for i, column in enumerate(columns)],
+                         [total[0] for key, total in pairs], [total[1] for key, total in pairs], moments)
+
+    def update(self, *args, **kwargs):
+        if args and len(args) > 1:
+            raise TypeError('expected at most 1 arguments, got %d' % len(args))
+        iterable = args[0] if args else None
+        if iterable is not None:
+            if isinstance(iterable, (Aggregator, ColumnarAggregator)):
+                _checkScales(self, iterable)
+            if isinstance(iterable, (Aggregator, ColumnarAggregator)) and iterable._fields == self._fields:
+                self._absorb(iterable)
+            elif isinstance(iterable, Mapping):
+                columns = [[] for f in self._fields]
+                counts, amounts, moments = [], [], []
+                for k, v in iterable.iteritems():
+                    key = self._keywrapper(*k) # fail if key can't match fields
+                    for index, value in enumerate(key):
+                        columns[index].append(self._encode(index, value))
+                    total = self._sum_totals(tuple(key), v)
+                    counts.append(total.count)
+                    amounts.append(total.amount)
+                    if not isinstance(v, tuple):
+                        moments.append((total.amount, total.amount, 0.0))
+                    else:
+                        moments.append((numpy.nan,) * 3 if total.count else _momentRow(None))
+                self._append(columns, counts, amounts, zip(*moments) or [(), (), ()])
+            else:
+                raise TypeError('expected a mapping between keys and values, got %s' % type(iterable))
+        if kwargs:
+            self.update(kwargs)
+
+    def update_many(self, rows, chunk_size=65536):
+        '''Accumulate an iterable of (field values..., amount) tuples, checking arity once per chunk.'''
+        n = len(self._fields)
+        for chunk in _chunks(rows, chunk_size):
+            if len(chunk[0]) != n + 1:
+                raise TypeError('expected rows of %d fields and an amount, got %d values' % (n, len(chunk[0])))
+            columns = zip(*chunk)
+            amounts = columns.pop()
+            self.update_columns(columns, amounts)
+
+    def update_columns(self, columns, amounts, counts=None):
+        '''Accumulate parallel sequences: one per field, plus amounts and optional counts.'''
+        if len(columns) != len(self._fields):
+            raise TypeError('expected %d key columns, got %d' % (len(self._fields), len(columns)))
+        amounts = numpy.asarray(amounts, dtype=numpy.float64) if self._scale is None else self._minor_units(columns, amounts)
+        moments = None
+        if counts is None:
+            counts = numpy.ones(len(amounts), dtype=numpy.int64)
+            moments = amounts, amounts, 0.0
+        else:
+            counts = numpy.asarray(counts, dtype=numpy.int64)
+        if len(counts) != len(amounts) or any(len(column) != len(amounts) for column in columns):
+            raise ValueError('key, amount and count columns differ in length')
+        self._append([self._encodeColumn(i, column) for i, column in enumerate(columns)], counts, amounts, moments)
+
+    def _minor_units(self, columns, amounts):
+        '''Convert a column of added amounts to int64 minor units, with each row's places
+           taken from its currency under a per-currency scale.
+        '''
+        if isinstance(self._scale, Mapping):
+            currencies = columns[self._currency_index()]
+            if isinstance(currencies, numpy.ndarray):
+                currencies = currencies.tolist()
+            known = dict((currency, self._currency_places(currency)) for currency in set(currencies))
+            places = map(known.__getitem__, currencies)
+        else:
+            places = [self._scale] * len(amounts)
+        if isinstance(amounts, numpy.ndarray):
+            if amounts.dtype.kind in 'iu':
+                # whole units: a multiply per row, not a conversion
+                return amounts.astype(numpy.int64) * 10 ** numpy.array(places, dtype=numpy.int64)
+            amounts = amounts.tolist()
+        return numpy.array(map(_minorUnits, amounts, places), dtype=numpy.int64)
+
+    @classmethod
+    def from_records(cls, records, key_fields, amount_field, fieldnames=None, chunk_size=65536):
+        '''Build a ColumnarAggregator from mappings or sequences, picking out key_fields and amount_field.
+
+        :param: fieldnames: fields of the new ColumnarAggregator, defaulting to key_fields.
+        '''
+        result = cls(fieldnames or key_fields)
+        _ingestRecords(result, records, key_fields, amount_field, chunk_size)
+        return result
+
+    def _encodeColumn(self, index, column):
+        '''Return the codes for a whole column of field values.'''
+        if isinstance(column, numpy.ndarray) and column.dtype != object:
+            uniques, inverse = numpy.unique(column, return_inverse=True)
+            translate = numpy.array([self._encode(index, v) for v in uniques.tolist()], dtype=numpy.int32)
+            return translate[inverse]
+        codes = self._codes[index]
+        for value in set(column).difference(codes):
+            self._encode(index, value)
+        return map(codes.__getitem__, column)
+
+    def iteritems(self, chunk_size=65536):
+        self._compact()
+        for start in xrange(0, self._size, chunk_size):
+            stop = min(start + chunk_size, self._size)
+            keys = [map(values.__getitem__, column[start:stop].tolist())
+                    for values, column in zip(self._values, self._columns)]
+            totals = itertools.imap(Total, self._count[start:stop].tolist(), self._amount[start:stop].tolist())
+            for key, total in itertools.izip(itertools.imap(self._keywrapper, *keys) if keys else itertools.repeat(self._keywrapper(), stop - start), totals):
+                yield key, total
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        self._compact()
+        n = self._size
+        return itertools.imap(Total, self._count[:n].tolist(), self._amount[:n].tolist())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iterkeys(self):
+        for key, total in self.iteritems():
+            yield tuple(key)
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iterfieldkeys(self, field):
+        index = self._fields.index(field)
+        values = self._values[index]
+        # group pending rows before reading the column, as that swaps in new arrays
+        self._compact()
+        for code in self._columns[index][:self._size].tolist():
+            yield values[code]
+
+    def fieldkeys(self, field):
+        index = self._fields.index(field)
+        values = self._values[index]
+        self._compact()
+        return set(values[code] for code in numpy.unique(self._columns[index][:self._size]).tolist())
+
+    def filter(self, *args, **kwargs):
+        '''Return a new ColumnarAggregator holding the keys which contain any of args in any field
+           and, for each field=value keyword, that value (or one of a tuple of values) in that field.
+        '''
+        self._compact()
+        n = self._size
+        mask = numpy.zeros(n, dtype=bool)
+        for k in args:
+            for index, column in enumerate(self._columns):
+                code = self._codes[index].get(k)
+                if code is not None:
+                    mask |= column[:n] == code
+        if kwargs:
+            if not args:
+                mask[:] = True
+            for field, values in kwargs.iteritems():
+                index = self._fields.index(field)
+                if not isinstance(values, (tuple, list, set, frozenset)):
+                    values = (values,)
+                codes = [self._codes[index][v] for v in values if v in self._codes[index]]
+                mask &= numpy.in1d(self._columns[index][:n], codes)
+        # a subset of sorted unique rows is still sorted and unique
+        moments = self._momentRows()
+        return self._spawn(self._fields, [c[:n][mask] for c in self._columns], self._count[:n][mask], self._amount[:n][mask],
+                           moments and [m[mask] for m in moments])
+
+    def collapse(self, *collapse_fields):
+        '''Remove one or more sub-key elements and merge values lacking them, returning a new ColumnarAggregator.'''
+        self._compact()
+        n = self._size
+        for field in collapse_fields:
+            self._fields.index(field)
+        fields = [f for f in self._fields if f not in collapse_fields]
+        columns = [c[:n] for f, c in zip(self._fields, self._columns) if f not in collapse_fields]
+        return self._spawn(fields, *_groupColumns(columns, self._count[:n], self._amount[:n], self._momentRows()))
+
+    def value_sorted(self, by_count=False, reverse=False):
+        self._compact()
+        n = self._size
+        primary, secondary = (self._count[:n], self._amount[:n]) if by_count else (self._amount[:n], self._count[:n])
+        order = numpy.lexsort((secondary, primary))
+        if reverse:
+            order = order[::-1]
+        items = self.items()
+        return [items[i] for i in order.tolist()]
+
+    def field_sorted(self, *field_keys, **kwargs):
+        self._compact()
+        n = self._size
+        ranks = []
+        for field in field_keys:
+            index = self._fields.index(field)
+            values = self._values[index]
+            # codes follow first appearance, so sort by each code's rank among the field's values
+            rank = numpy.empty(len(values), dtype=numpy.int32)
+            rank[sorted(xrange(len(values)), key=values.__getitem__)] = numpy.arange(len(values), dtype=numpy.int32)
+            ranks.append(rank[self._columns[index][:n]])
+        order = numpy.lexsort(ranks[::-1]) if ranks else numpy.arange(n)
+        if kwargs.get('reverse'):
+            order = order[::-1]
+        items = self.items()
+        return [items[i] for i in order.tolist()]
+
+    def top(self, k, by='amount', within=None):
+        '''Return the k (Key, Total) pairs with the largest amount (or count), largest first.'''
+        return self._extremes(k, by, within, True)
+
+    def bottom(self, k, by='amount', within=None):
+        '''Return the k (Key, Total) pairs with the smallest amount (or count), smallest first.'''
+        return self._extremes(k, by, within, False)
+
+    def _extremes(self, k, by, within, largest):
+        _totalSortKey(by)
+        source = self.filter(**within) if within else self
+        source._compact()
+        n = source._size
+        primary, secondary = (source._count[:n], source._amount[:n]) if by == 'count' else (source._amount[:n], source._count[:n])
+        rows = numpy.arange(n)
+        if k <= 0:
+            return []
+        if k < n:
+            # partition on the primary total, then order only the candidates reaching the k-th value
+            kth = numpy.partition(-primary if largest else primary, k - 1)[k - 1]
+            rows = numpy.flatnonzero(primary >= -kth if largest else primary <= kth)
+        order = rows[numpy.lexsort((secondary[rows], primary[rows]))]
+        if largest:
+            order = order[::-1]
+        order = order[:k].tolist()
+        keys = [[values[c] for c in column[order].tolist()] for values, column in zip(source._values, source._columns)]
+        keys = itertools.imap(source._keywrapper, *keys) if keys else itertools.repeat(source._keywrapper(), len(order))
+        return zip(keys, itertools.imap(Total, source._count[order].tolist(), source._amount[order].tolist()))
+
+    def write_csv(self, target, *sort_keys, **kwargs):
+        '''Write a header and one row per key to a file object or path; see Aggregator.write_csv.'''
+        reverse = kwargs.pop('reverse', False)
+        compress = kwargs.pop('compress', False)
+        rows = (tuple(key) + total for key, total in self.iteritems())
+        if sort_keys:
+            rows = sorted(rows, key=_keyGetter(self._fields.index(f) for f in sort_keys), reverse=reverse)
+        _writeCsv(target, self._fields + ('count', 'amount'), self._csv_rows(rows), compress, kwargs)
+
+    def save(self, path):
+        '''Write a binary snapshot; see Aggregator.save.'''
+        self._compact()
+        n = self._size
+        _saveSnapshot(path, self._fields, self._values, [c[:n] for c in self._columns], self._count[:n], self._amount[:n],
+                      self._config(), self._momentRows())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''Open a snapshot written by save. With mmap the arrays are read-only views on
+           a shared memory mapping of the file, so nothing is parsed or copied up front.
+        '''
+        return _restoreColumnar(*_loadSnapshot(path, mmap))
+
+    def to_aggregator(self):
+        '''Return the contents as a dict-backed Aggregator.'''
+        result = Aggregator(self._fields, **self._config())
+        for key, total in self.iteritems():
+            dict.__setitem__(result, tuple(key), total)
+        if self._measures:
+            _fillMoments(result._sidecars['measures'][1], ((tuple(key), total) for key, total in self.iteritems()), self._momentRows())
+        return result
+
+
+class WindowedAggregator(object):
+    # Keeps one Aggregator per fixed-width time pane in a ring buffer, with optional running totals for a sliding window and for the current day.
+
+    '''Create a time-bucketed Aggregator made of tumbling panes of a fixed width.
+
+    Timestamps may be datetimes (naive, taken as UTC), dates, or seconds since the
+    epoch. Each pane is an Aggregator; the oldest pane is evicted once `retention`
+    panes have been opened after it, and transactions older than that are dropped
+    and counted in `late`.
+
+    :param: fieldnames: fields of the per-pane Aggregators.
+    :param: width: pane width, as a timedelta or in seconds.
+    :param: retention: number of panes kept.
+    :param: sliding: length of a sliding window (a multiple of width, up to the
+            retention) whose totals are kept running, so reading them needs no merge.
+    :param: daily: also keep running totals for the day of the newest pane.
+    :param: factory: the Aggregator class used for panes and running totals.
+    '''
+
+    def __init__(self, fieldnames, width, retention=96, sliding=None, daily=False, factory=Aggregator):
+        self._fields = tuple(fieldnames)
+        self._width = _seconds(width)
+        self._retention = retention
+        self._slots = [None] * retention  # (pane number, Aggregator) at pane number % retention
+        self._newest = None
+        self._slide = None
+        if sliding is not None:
+            self._slide = int(round(_seconds(sliding) / self._width))
+            if not 0 < self._slide <= retention:
+                raise ValueError('sliding window must span 1 to %d panes' % retention)
+        self._factory = factory
+        self._running = factory(self._fields) if self._slide else None
+        self._daily = daily
+        self._day, self._today = None, factory(self._fields)
+        self.late = 0
+
+    def _pane(self, number, create=False):
+        entry = self._slots[number % self._retention]
+        if entry is not None and entry[0] == number:
+            return entry[1]
+        if create:
+            # opening the slot evicts whichever older pane held it
+            pane = self._factory(self._fields)
+            self._slots[number % self._retention] = (number, pane)
+            return pane
+        return None
+
+    def _advance(self, number):
+        '''Make number the newest pane, taking panes which leave the sliding window out of its running totals.'''
+        if self._slide and self._newest is not None:
+            if number - self._slide >= self._newest:
+                self._running = self._factory(self._fields)
+            else:
+                for leaving in xrange(self._newest - self._slide + 1, number - self._slide + 1):
+                    pane = self._pane(leaving)
+                    if pane is not None:
+                        _subtractTotals(self._running, pane)
+        self._newest = number
+
+    def _apply(self, number, method, data):
+        if self._newest is None or number > self._newest:
+            self._advance(number)
+        elif number <= self._newest - self._retention:
+            self.late += len(data)
+            return
+        getattr(self._pane(number, True), method)(data)
+        if self._slide and number > self._newest - self._slide:
+            getattr(self._running, method)(data)
+        if self._daily:
+            day = datetime.utcfromtimestamp(number * self._width).date()
+            if self._day is None or day > self._day:
+                self._day, self._today = day, self._factory(self._fields)
+            if day == self._day:
+                getattr(self._today, method)(data)
+
+    def update(self, timestamp, mapping):
+        '''Add a mapping of keys to values, as for Aggregator.update, at timestamp.'''
+        self._apply(int(_seconds(timestamp) // self._width), 'update', mapping)
+
+    def update_many(self, rows):
+        '''Accumulate (timestamp, field values..., amount) rows, one bulk update per pane.'''
+        panes = {}
+        for row in rows:
+            panes.setdefault(int(_seconds(row[0]) // self._width), []).append(row[1:])
+        for number in sorted(panes):
+            self._apply(number, 'update_many', panes[number])
+
+    def panes(self):
+        '''Return the retained (pane start in epoch seconds, Aggregator) pairs, oldest first.'''
+        return [(number * self._width, pane) for number, pane in sorted(e for e in self._slots if e is not None)]
+
+    def window(self, duration=None, end=None):
+        '''Return the totals of the panes covering duration up to end (default: the newest
+           pane), or of every retained pane when duration is None.
+        '''
+        result = self._factory(self._fields)
+        if self._newest is None:
+            return result
+        last = self._newest if end is None else int(math.ceil(_seconds(end) / self._width)) - 1
+        first = last - self._retention + 1 if duration is None else last - int(math.ceil(_seconds(duration) / self._width)) + 1
+        for number in xrange(max(first, self._newest - self._retention + 1), last + 1):
+            pane = self._pane(number)
+            if pane is not None:
+                result += pane
+        return result
+
+    def sliding(self):
+        '''Return the running totals of the sliding window ending with the newest pane.'''
+        if self._running is None:
+            raise ValueError('no sliding window was configured')
+        return self._running.copy()
+
+    def today(self):
+        '''Return the running totals for the day of the newest pane.'''
+        if not self._daily:
+            raise ValueError('daily totals were not configured')
+        return self._today.copy()
+
+
+class BatchIngestor(object):
+    # Moves per-message ingest off the producers' threads: messages queue up and a worker applies them to the aggregator in bulk.
+
+    '''Feed an aggregator from producer threads in micro-batches, through a bounded queue.
+
+    A worker thread collects rows from the queue until batch_size of them have
+    arrived or interval seconds have passed since the first, then applies them in
+    one bulk call (update_many by default) while holding `lock`. put blocks while
+    the queue is full, so slow aggregation pushes back on producers instead of
+    buffering without bound. Readers wanting a consistent view of the aggregator
+    while ingest runs should hold `lock`.
+
+    :param: target: the aggregator to feed, or anything with update_many.
+    :param: batch_size: rows per bulk call at most.
+    :param: interval: longest time in seconds a row waits for its batch to fill.
+    :param: maxsize: queue entries (rows, or chunks from put_many) held before put blocks.
+    :param: queue: an existing Queue.Queue producers already write rows to.
+    :param: apply: callable taking a list of rows, instead of target.update_many.
+    '''
+
+    def __init__(self, target, batch_size=10000, interval=0.5, maxsize=100000, queue=None, apply=None):
+        self.target = target
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = Queue.Queue(maxsize) if queue is None else queue
+        self.lock = threading.RLock()
+        self.batches = self.rows = 0
+        self.error = None
+        self._apply = apply or target.update_many
+        self._worker = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='BatchIngestor')
+            self._worker.daemon = True
+            self._worker.start()
+        return self
+
+    def put(self, row, timeout=None):
+        '''Queue one row, waiting up to timeout seconds (forever by default) for room; raises Queue.Full on timeout.'''
+        self.queue.put(row, True, timeout)
+
+    def put_many(self, rows, timeout=None):
+        '''Queue a list of rows as one entry.'''
+        self.queue.put(_Rows(rows), True, timeout)
+
+    def feed(self, iterable):
+        '''Start a thread putting every row of iterable (a feed, a generator) on the queue, returning the thread.'''
+        def pump():
+            for row in iterable:
+                self.queue.put(row)
+        thread = threading.Thread(target=pump, name='BatchIngestor.feed')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def flush(self, timeout=None):
+        '''Wait until every row queued so far has been applied, re-raising the first error in applying one.'''
+        done = _Flush()
+        self.queue.put(done)
+        if not done.applied.wait(timeout):
+            raise RuntimeError('rows still pending after %s seconds' % timeout)
+        self._raise()
+
+    def stop(self):
+        '''Apply the rows queued so far and stop the worker.'''
+        if self._worker is not None:
+            self.queue.put(_STOP)
+            self._worker.join()
+            self._worker = None
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        queue, clock = self.queue, timeit.default_timer
+        batch, deadline = [], None
+        while True:
+            try:
+                if not batch:
+                    item = queue.get()
+                else:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    item = queue.get(True, remaining)
+            except Queue.Empty:
+                batch = self._commit(batch)
+                continue
+            if item is _STOP:
+                self._commit(batch)
+                return
+            if isinstance(item, _Flush):
+                batch = self._commit(batch)
+                item.applied.set()
+                continue
+            if not batch:
+                deadline = clock() + self.interval
+            if type(item) is _Rows:
+                batch.extend(item)
+            else:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                batch = self._commit(batch)
+
+    def _commit(self, batch):
+        '''Apply batch to the target, keeping the first error for flush or stop, and return a new empty batch.'''
+        if batch:
+            try:
+                with self.lock:
+                    self._apply(batch)
+                self.batches += 1
+                self.rows += len(batch)
+            except Exception as error:
+                # keep draining, so producers blocked on a full queue aren't stranded
+                if self.error is None:
+                    self.error = error
+        return []
+
+
+class ConcurrentAggregator(object):
+    # Spreads keys over independently locked shard Aggregators, so writer threads only contend when they touch the same shard.
+
+    '''Create an Aggregator safe to update from many threads at once, by lock striping.
+
+    Each key lives in one of `shards` Aggregators, chosen by its hash, and every
+    shard has its own lock. Writes group their rows by shard and apply each group
+    in one bulk call under that shard's lock, so read-modify-write sums are never
+    lost. snapshot() returns an ordinary Aggregator for filter, collapse, top and
+    the rest; since shards hold disjoint keys it is a copy, not a merge.
+
+    :param: fieldnames: fields of the shard Aggregators.
+    :param: shards: number of shards and locks.
+    :param: factory: the Aggregator class used for shards.
+    :param: config: keyword settings for the shards, e.g. measures or scale.
+    '''
+
+    def __init__(self, fieldnames, shards=16, factory=Aggregator, **config):
+        self._fields = tuple(fieldnames)
+        self._shards = [factory(self._fields, **config) for i in xrange(shards)]
+        self._locks = [threading.Lock() for i in xrange(shards)]
+
+    def _partition(self, keyed):
+        '''Group (key tuple, item) pairs into per-shard lists of items.'''
+        n = len(self._shards)
+        parts = collections.defaultdict(list)
+        for key, item in keyed:
+            parts[hash(key) % n].append(item)
+        return parts.iteritems()
+
+    def update(self, mapping):
+        '''Add a mapping of keys to amounts or Totals, as for Aggregator.update.'''
+        if isinstance(mapping, (Aggregator, ConcurrentAggregator)):
+            _checkScales(self._shards[0], mapping._shards[0] if isinstance(mapping, ConcurrentAggregator) else mapping)
+            mapping = dict(mapping.snapshot()._pairs() if isinstance(mapping, ConcurrentAggregator) else mapping._pairs())
+        for index, items in self._partition((tuple(key), (key, value)) for key, value in mapping.iteritems()):
+            with self._locks[index]:
+                self._shards[index].update(dict(items))
+
+    def __iadd__(self, other):
+        self.update(other)
+        return self
+
+    def update_many(self, rows, chunk_size=65536):
+        '''Accumulate an iterable of (field values..., amount) tuples, as for Aggregator.update_many.'''
+        getkey = _keyGetter(range(len(self._fields)))
+        for chunk in _chunks(rows, chunk_size):
+            for index, part in self._partition(itertools.izip(map(getkey, chunk), chunk)):
+                with self._locks[index]:
+                    self._shards[index].update_many(part, chunk_size)
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        index = hash(key) % len(self._shards)
+        with self._locks[index]:
+            return self._shards[index][key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return sum(map(len, self._shards))
+
+    def snapshot(self):
+        '''Return the totals as one Aggregator, each shard copied under its lock.'''
+        result = self._shards[0]._derive(self._fields)
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                result._extend(shard._pairs())
+                result._merge_sidecars(shard)
+        return result
+
+    def __reduce__(self):
+        return (_restoreConcurrent, (self._fields, len(self._shards), self.snapshot()))
+
+    def __repr__(self):
+        return repr(self.snapshot())
+
+    def iteritems(self):
+        return self.snapshot().iteritems()
+
+    def items(self):
+        return self.snapshot().items()
+
+    def filter(self, *args, **kwargs):
+        return self.snapshot().filter(*args, **kwargs)
+
+    def collapse(self, *fields):
+        return self.snapshot().collapse(*fields)
+
+    def query(self):
+        return self.snapshot().query()
+
+
+class _Rows(list):
+    '''A chunk of rows queued as one BatchIngestor entry.'''
+
+
+class _Flush(object):
+    '''A BatchIngestor queue marker whose event is set once every row ahead of it has been applied.'''
+
+    def __init__(self):
+        self.applied = threading.Event()
+
+
+_STOP = object()
+
+
+class Moments(object):
+    '''Count, sum, min, max and spread of a run of amounts, mergeable without the amounts.
+
+    Spread is kept as the sum of squared deviations from the mean (m2), combined
+    by Chan's parallel formula, which stays accurate where a raw sum of squares
+    would cancel away against a large mean. Pre-aggregated amounts come with no
+    spread: once any are merged in, low, high and m2 are None.
+    '''
+
+    __slots__ = ('count', 'total', 'low', 'high', 'm2')
+
+    def __init__(self):
+        # total starts as an int, so minor units stay exact
+        self.count, self.total, self.low, self.high, self.m2 = 0, 0, None, None, 0.0
+
+    def __getstate__(self):
+        return self.count, self.total, self.low, self.high, self.m2
+
+    def __setstate__(self, state):
+        self.count, self.total, self.low, self.high, self.m2 = state
+
+    def add_summary(self, count, total, low, high, m2):
+        '''Merge in the summary of count more amounts, with None for an unknown low, high or m2.'''
+        if not count:
+            return
+        if self.count:
+            if m2 is None or self.m2 is None:
+                self.m2 = None
+            else:
+                delta = float(total) / count - float(self.total) / self.count
+                self.m2 += m2 + delta * delta * self.count * count / (self.count + count)
+            self.low = None if low is None or self.low is None else min(self.low, low)
+            self.high = None if high is None or self.high is None else max(self.high, high)
+        else:
+            self.m2, self.low, self.high = m2, low, high
+        self.count += count
+        self.total += total
+
+    def add(self, value):
+        self.add_summary(1, value, value, value, 0.0)
+
+    def merge(self, other):
+        self.add_summary(other.count, other.total, other.low, other.high, other.m2)
+
+    def copy(self):
+        result = Moments.__new__(Moments)
+        result.__setstate__(self.__getstate__())
+        return result
+
+    def mean(self):
+        return _measureValues(self.count, self.total, self.low, self.high, self.m2)['mean']
+
+    def variance(self):
+        return _measureValues(self.count, self.total, self.low, self.high, self.m2)['variance']
+
+    def stddev(self):
+        return _measureValues(self.count, self.total, self.low, self.high, self.m2)['stddev']
+
+    def sumsq(self):
+        return _measureValues(self.count, self.total, self.low, self.high, self.m2)['sumsq']
+
+    def __repr__(self):
+        return 'Moments(count=%d, mean=%r, min=%r, max=%r, variance=%r)' % (self.count, self.mean(), self.low, self.high, self.variance())
+
+
+class HyperLogLog(object):
+    '''Estimate how many distinct values were added in fixed memory: 2**precision one-byte registers.
+
+    The relative standard error is about 1.04 / sqrt(2**precision), so 1.6% at the
+    default precision of 12 (4KB). Sketches of equal precision merge losslessly, so
+    a merged sketch estimates the distinct count of the union. Values are hashed
+    by content, so sketches built in other processes merge soundly too.
+
+    :param: precision: number of hash bits choosing a register, from 4 to 16.
+    '''
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16, got %r' % (precision,))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def __getstate__(self):
+        return self.precision, self.registers
+
+    def __setstate__(self, state):
+        self.precision, self.registers = state
+
+    def add(self, value):
+        hashed = _stableHash(value)
+        rest = 64 - self.precision
+        # register from the top bits; rank is the position of the first 1 in the rest
+        index, bits = hashed >> rest, hashed & ((1 << rest) - 1)
+        rank = rest - bits.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('cannot merge sketches of precision %d and %d' % (self.precision, other.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def copy(self):
+        result = HyperLogLog.__new__(HyperLogLog)
+        result.precision, result.registers = self.precision, bytearray(self.registers)
+        return result
+
+    def count(self):
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / math.fsum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count('\0')
+        if estimate <= 2.5 * m and zeros:
+            # small cardinalities: linear counting over the empty registers is more accurate
+            return m * math.log(float(m) / zeros)
+        return estimate
+
+    def __len__(self):
+        return int(round(self.count()))
+
+    def __repr__(self):
+        return 'HyperLogLog(precision=%d, count~%d)' % (self.precision, len(self))
+
+
+class KLL(object):
+    '''Estimate quantiles of a stream of numbers in bounded memory (Karnin, Lang and Liberty).
+
+    Values are kept in a stack of compactors; when the sketch is full, the lowest
+    full compactor sorts itself and promotes every other value, at double weight,
+    to the next. About 3k values are held whatever the stream length, and ranks
+    are off by roughly 1.7/k of the stream. Sketches merge by stacking compactors.
+
+    :param: k: size of the top compactor; larger is more accurate.
+    '''
+
+    __slots__ = ('k', 'compactors', 'size', 'capacity', 'n')
+
+    def __init__(self, k=200):
+        if k < 8:
+            raise ValueError('k must be at least 8, got %r' % (k,))
+        self.k = k
+        self.compactors = []
+        self.size = self.n = 0
+        self._grow()
+
+    def __getstate__(self):
+        return self.k, self.compactors, self.size, self.capacity, self.n
+
+    def __setstate__(self, state):
+        self.k, self.compactors, self.size, self.capacity, self.n = state
+
+    def _grow(self):
+        self.compactors.append([])
+        self.capacity = sum(self._level_capacity(h) for h in xrange(len(self.compactors)))
+
+    def _level_capacity(self, h):
+        # capacities shrink geometrically (by 2/3) below the top compactor
+        return int(math.ceil((2.0 / 3) ** (len(self.compactors) - h - 1) * self.k)) + 1
+
+    def _compress(self):
+        for h, compactor in enumerate(self.compactors):
+            if len(compactor) >= self._level_capacity(h):
+                if h + 1 == len(self.compactors):
+                    self._grow()
+                compactor.sort()
+                # keep the odd one out, promote the odd or even positions of the rest
+                last = [compactor.pop()] if len(compactor) % 2 else []
+                self.compactors[h + 1].extend(compactor[random.getrandbits(1)::2])
+                compactor[:] = last
+                self.size = sum(map(len, self.compactors))
+                if self.size < self.capacity:
+                    break
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        self.n += 1
+        if self.size >= self.capacity:
+            self._compress()
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for compactor, theirs in zip(self.compactors, other.compactors):
+            compactor.extend(theirs)
+        self.size = sum(map(len, self.compactors))
+        self.n += other.n
+        while self.size >= self.capacity:
+            self._compress()
+
+    def copy(self):
+        result = KLL.__new__(KLL)
+        result.__setstate__((self.k, [list(c) for c in self.compactors], self.size, self.capacity, self.n))
+        return result
+
+    def _weighted(self):
+        '''Return the held values with their weights, sorted by value.'''
+        return sorted((value, 1 << h) for h, compactor in enumerate(self.compactors) for value in compactor)
+
+    def rank(self, value):
+        '''Return the estimated fraction of the stream at or below value.'''
+        weighted = self._weighted()
+        if not weighted:
+            return 0.0
+        return sum(weight for v, weight in weighted if v <= value) / float(sum(weight for v, weight in weighted))
+
+    def quantiles(self, qs):
+        '''Return the estimated value at each fraction in qs (0 to 1), or Nones for an empty sketch.'''
+        weighted = self._weighted()
+        if not weighted:
+            return [None for q in qs]
+        cumulative, total = [], 0
+        for value, weight in weighted:
+            total += weight
+            cumulative.append(total)
+        return [weighted[min(bisect.bisect_left(cumulative, q * total), len(weighted) - 1)][0] for q in qs]
+
+    def quantile(self, q):
+        return self.quantiles((q,))[0]
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return 'KLL(k=%d, n=%d, held=%d)' % (self.k, self.n, self.size)
+
+
+#################################################
+##                Functions
+#################################################
+
+def sumTotals(*t):
+    count, amount = 0, 0.0
+    for total in t:
+        if isinstance(total, (int, float)):
+            count += 1
+            amount += float(total)
+        else:
+            count += int(total[0])
+            amount += float(total[1])
+    return Total(count, amount)
+
+
+def parallelAggregate(sources, build, processes=None):
+    '''Call build(source) for each source across a multiprocessing pool, then combine the
+       results by pairwise tree reduction.
+
+    build must be picklable (a module-level function, or a functools.partial of one)
+    and return same-schema Aggregators or ColumnarAggregators.
+    '''
+    pool = multiprocessing.Pool(processes)
+    try:
+        parts = pool.map(build, sources)
+        if not parts:
+            raise ValueError('no sources to aggregate')
+        # reduce level by level in the pool; the last pair is merged here to save a round trip
+        while len(parts) > 2:
+            merged = pool.map(_mergePair, zip(parts[0::2], parts[1::2]))
+            if len(parts) % 2:
+                merged.append(parts[-1])
+            parts = merged
+    finally:
+        pool.close()
+        pool.join()
+    return _mergePair(parts) if len(parts) == 2 else parts[0]
+
+
+def _mergePair(pair):
+    '''Merge the smaller of two same-schema aggregators into the larger.'''
+    smaller, larger = sorted(pair, key=len)
+    larger += smaller
+    return larger
+
+
+def _csvShard(cls, key_columns, amount_column, fieldnames, csv_kwargs, path):
+    return cls.from_csv(path, key_columns, amount_column, fieldnames, **csv_kwargs)
+
+
+def _rowsShard(cls, fieldnames, rows):
+    result = cls(fieldnames)
+    result.update_many(rows)
+    return result
+
+
+def _restoreAggregator(cls, fields, store, sidecars=None, config=None):
+    result = cls(fields, **(config or {}))
+    result._extend(store.iteritems())
+    if sidecars:
+        result._sidecars = sidecars
+    return result
+
+
+def _restoreConcurrent(fields, shards, snapshot):
+    result = ConcurrentAggregator(fields, shards, snapshot.__class__, **snapshot._config())
+    result.update(snapshot)
+    return result
+
+
+def _restoreColumnar(fields, values, columns, count, amount, config=None, moments=None):
+    result = ColumnarAggregator(fields, **(config or {}))
+    result._values = values
+    result._codes = [dict((v, i) for i, v in enumerate(vals)) for vals in values]
+    result._columns, result._count, result._amount = columns, count, amount
+    if result._moments is not None:
+        result._moments = list(moments) if moments is not None else [numpy.array(m, dtype=numpy.float64) for m in _unknownMoments(count)]
+    result._size = result._grouped = len(count)
+    return result
+
+
+def _checkScales(agg, other):
+    '''Raise ValueError unless two aggregators store amounts the same way: both as floats,
+       or as minor units with the same scale (and currency field, for a per-currency scale).
+    '''
+    mine, theirs = [(a._scale, a._currency if isinstance(a._scale, Mapping) else None) for a in (agg, other)]
+    if mine != theirs:
+        raise ValueError('cannot combine amounts with scale %r (currency %r) and scale %r (currency %r)' % (mine + theirs))
+
+
+def _chunks(iterable, size):
+    '''Yield successive lists of at most size items from iterable.'''
+    iterable = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _keyGetter(indexes):
+    '''Return a callable picking indexes out of a row as a tuple, however many there are.'''
+    indexes = list(indexes)
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    if not indexes:
+        return lambda row: ()
+    return operator.itemgetter(*indexes)
+
+
+def _ingestRecords(agg, records, key_fields, amount_field, chunk_size):
+    getrow = operator.itemgetter(*(list(key_fields) + [amount_field]))
+    for chunk in _chunks(records, chunk_size):
+        agg.update_many(map(getrow, chunk), chunk_size)
+
+
+def _ingestCsv(agg, fileobj, key_columns, amount_column, chunk_size, csv_kwargs):
+    if isinstance(fileobj, basestring):
+        with open(fileobj, 'rb') as fd:
+            return _ingestCsv(agg, fd, key_columns, amount_column, chunk_size, csv_kwargs)
+    # csv.reader gives an empty list for a blank line: pass over those rather than count them skipped
+    reader = itertools.ifilter(None, csv.reader(fileobj, **csv_kwargs))
+    columns = list(key_columns) + [amount_column]
+    if not all(isinstance(c, int) for c in columns):
+        header = next(reader, None)
+        if header is None:
+            # an empty file: no header to resolve names against, and no rows either
+            return Ingested(0, 0)
+        columns = [c if isinstance(c, int) else header.index(c) for c in columns]
+    getrow = _keyGetter(columns)
+    rows = skipped = 0
+    for chunk in _chunks(reader, chunk_size):
+        try:
+            agg.update_many(map(getrow, chunk), chunk_size)
+            rows += len(chunk)
+            continue
+        except (IndexError, ValueError):
+            pass
+        # something in this chunk is malformed: nothing was applied, so sort it out row by row
+        good = []
+        for row in chunk:
+            try:
+                good.append(getrow(row))
+            except IndexError:
+                skipped += 1
+        applied = _applyRows(agg, good, chunk_size)
+        rows += applied
+        skipped += len(good) - applied
+    return Ingested(rows, skipped)
+
+
+def _applyRows(agg, rows, chunk_size):
+    '''Apply rows with update_many, halving around any update_many rejects (an unparseable
+       amount, an unknown currency); return how many were applied.
+    '''
+    if not rows:
+        return 0
+    try:
+        agg.update_many(rows, chunk_size)
+        return len(rows)
+    except (IndexError, ValueError):
+        if len(rows) == 1:
+            return 0
+    half = len(rows) // 2
+    return _applyRows(agg, rows[:half], chunk_size) + _applyRows(agg, rows[half:], chunk_size)
+
+
+def _writeCsv(target, header, rows, compress, csv_kwargs):
+    if isinstance(target, basestring):
+        with open(target, 'wb') as fd:
+            return _writeCsv(fd, header, rows, compress or target.endswith('.gz'), csv_kwargs)
+    if compress:
+        zipped = gzip.GzipFile(fileobj=target, mode='wb')
+        try:
+            return _writeCsv(zipped, header, rows, False, csv_kwargs)
+        finally:
+            zipped.close()
+    writer = csv.writer(target, **csv_kwargs)
+    writer.writerow(header)
+    writer.writerows(rows)
+
+
+SNAPSHOT_MAGIC = 'AGGSNAP1'
+
+def _saveSnapshot(path, fields, values, columns, count, amount, config, moments=None):
+    # amounts are int64 minor units under a scale; (low, high, m2) float64 columns follow when measures are kept
+    amount_dtype = '<f8' if config.get('scale') is None else '<i8'
+    header = cPickle.dumps({'fields': tuple(fields), 'values': values, 'rows': len(count), 'config': config,
+                            'amount': amount_dtype, 'moments': moments is not None}, 2)
+    arrays = [(c, '<i4') for c in columns] + [(count, '<i8'), (amount, amount_dtype)] + [(m, '<f8') for m in moments or ()]
+    with open(path, 'wb') as fd:
+        fd.write(SNAPSHOT_MAGIC + struct.pack('<I', len(header)) + header)
+        for array, dtype in arrays:
+            # every array starts on an 8-byte boundary so it can be viewed in place
+            fd.write('\0' * (-fd.tell() % 8))
+            numpy.asarray(array, dtype=dtype).tofile(fd)
+
+
+def _loadSnapshot(path, mapped):
+    '''Return (fields, values, columns, count, amount, config, moments) from a snapshot file,
+       with moments None when it holds no (low, high, m2) columns.
+    '''
+    if numpy is None:
+        raise ImportError('Aggregator snapshots require numpy')
+    with open(path, 'rb') as fd:
+        magic, size = fd.read(len(SNAPSHOT_MAGIC)), struct.unpack('<I', fd.read(4))[0]
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not an aggregator snapshot' % path)
+        header = cPickle.loads(fd.read(size))
+        n = header['rows']
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if mapped and n else None
+        offset = fd.tell()
+        arrays = []
+        moments = 3 if header.get('moments') else 0
+        dtypes = ['<i4'] * len(header['fields']) + ['<i8', header.get('amount', '<f8')] + ['<f8'] * moments
+        for dtype in dtypes:
+            offset += -offset % 8
+            if buf is not None:
+                arrays.append(numpy.frombuffer(buf, dtype=dtype, count=n, offset=offset))
+            else:
+                fd.seek(offset)
+                arrays.append(numpy.fromfile(fd, dtype=dtype, count=n))
+            offset += n * numpy.dtype(dtype).itemsize
+    columns = arrays[:len(header['fields'])]
+    count, amount = arrays[len(columns)], arrays[len(columns) + 1]
+    return header['fields'], header['values'], columns, count, amount, header.get('config', {}), arrays[len(columns) + 2:] or None
+
+
+def _minorUnits(value, places):
+    '''Return an amount as an integer number of 10**-places units, rounding half to even.
+
+    Strings and Decimals convert exactly; floats by way of their shortest repr,
+    so 0.285 is 28.5 cents rather than 28.4999... .
+    '''
+    if isinstance(value, (int, long)):
+        return value * 10 ** places
+    if isinstance(value, float):
+        value = repr(value)
+    if isinstance(value, basestring):
+        # plain [-]digits[.digits] with no more decimals than places is most of what arrives
+        whole, point, fraction = value.strip().partition('.')
+        digits = whole.lstrip('+-')
+        if (digits.isdigit() or not digits and fraction.isdigit()) and len(whole) - len(digits) <= 1 \
+                and len(fraction) <= places and (fraction.isdigit() or not fraction):
+            units = int(digits or 0) * 10 ** places + int(fraction.ljust(places, '0') or 0)
+            return -units if whole.startswith('-') else units
+        try:
+            value = decimal.Decimal(value.strip())
+        except decimal.InvalidOperation:
+            raise ValueError('invalid amount %r' % (value,))
+    if not value.is_finite():
+        raise ValueError('invalid amount %r' % (value,))
+    return int(value.scaleb(places).to_integral_value(decimal.ROUND_HALF_EVEN))
+
+
+def _feedSketches(factory, sketches, pairs):
+    '''Add each (key, value) pair's value to the key's sketch, creating sketches as needed.'''
+    get = sketches.get
+    for key, value in pairs:
+        sketch = get(key)
+        if sketch is None:
+            sketch = sketches[key] = factory()
+        sketch.add(value)
+
+
+_UINT64 = struct.Struct('<Q')
+
+def _measureValues(count, total, low, high, m2):
+    '''Return every one of MEASURES from a count, sum, min, max and m2, with None where unknown.'''
+    known = count and m2 is not None
+    return {'count': count, 'sum': total, 'min': low, 'max': high,
+            'mean': float(total) / count if count else None,
+            'sumsq': (m2 + float(total) * total / count if known else None) if count else 0.0,
+            'variance': m2 / count if known else None,
+            'stddev': math.sqrt(m2 / count) if known else None}
+
+
+def _summarizeBatch(keys, amounts):
+    '''Return (key, count, sum, min, max, m2) for each distinct key among parallel keys and amounts.
+
+    With numpy the amounts are grouped by key in arrays, so the only Python work
+    per row is numbering its key; without it they are summed in running lists.
+    '''
+    values = None
+    if numpy is not None:
+        values = numpy.array(amounts if isinstance(amounts, list) else list(amounts))
+        # integer minor units are summed in int64, so only while they can't overflow it
+        if values.dtype.kind not in 'fi' or values.dtype.kind == 'i' and len(values) and \
+                float(numpy.abs(values).max()) * len(values) >= 2.0 ** 62:
+            amounts, values = values.tolist(), None
+    if values is None:
+        batch = {}
+        get = batch.get
+        for key, amount in itertools.izip(keys, amounts):
+            running = get(key)
+            if running is None:
+                # count, amount, min, max, shift, shifted sum, shifted sum of squares
+                batch[key] = [1, amount, amount, amount, amount, 0.0, 0.0]
+            else:
+                running[0] += 1
+                running[1] += amount
+                if amount < running[2]:
+                    running[2] = amount
+                elif amount > running[3]:
+                    running[3] = amount
+                # squares taken about the key's first amount, so variance doesn't cancel away
+                deviation = amount - running[4]
+                running[5] += deviation
+                running[6] += deviation * deviation
+        return [(key, count, amount, low, high, dsq - dsum * dsum / count)
+                for key, (count, amount, low, high, shift, dsum, dsq) in batch.iteritems()]
+    numbers = {}
+    number = numbers.setdefault
+    codes = numpy.fromiter((number(key, len(numbers)) for key in keys), dtype=numpy.intp, count=len(values))
+    if not len(codes):
+        return []
+    counts = numpy.bincount(codes)
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    values = values[numpy.argsort(codes, kind='mergesort')]
+    sums = numpy.add.reduceat(values, starts)
+    # squared deviations from each key's own mean, which don't cancel away against a large mean
+    deviations = values - numpy.repeat(sums / counts.astype(numpy.float64), counts)
+    unique = [None] * len(numbers)
+    for key, code in numbers.iteritems():
+        unique[code] = key
+    return zip(unique, counts.tolist(), sums.tolist(), numpy.minimum.reduceat(values, starts).tolist(),
+               numpy.maximum.reduceat(values, starts).tolist(), numpy.add.reduceat(deviations * deviations, starts).tolist())
+
+
+def _momentRow(summary):
+    '''Return the (low, high, m2) of a Moments as floats, with nan where unknown and
+       the identities (inf, -inf, 0) for no transactions at all.
+    '''
+    if summary is None or not summary.count:
+        return numpy.inf, -numpy.inf, 0.0
+    return tuple(numpy.nan if v is None else v for v in (summary.low, summary.high, summary.m2))
+
+
+def _fillMoments(summaries, pairs, moments):
+    '''Set key -> Moments from (key tuple, Total) pairs and their (low, high, m2) columns.'''
+    for (key, total), low, high, m2 in itertools.izip(pairs, *[numpy.asarray(m).tolist() for m in moments]):
+        if total[0]:
+            summary = summaries[key] = Moments()
+            summary.add_summary(total[0], total[1], *[None if math.isnan(v) else v for v in (low, high, m2)])
+
+
+def _unknownMoments(count):
+    '''Return (low, high, m2) columns for pre-aggregated rows: unknown (nan) where there
+       are transactions, the identities where there are none.
+    '''
+    empty = numpy.asarray(count) == 0
+    unknown = numpy.where(empty, 0.0, numpy.nan)
+    return numpy.where(empty, numpy.inf, numpy.nan), numpy.where(empty, -numpy.inf, numpy.nan), unknown
+
+
+def _stableHash(value):
+    '''Return a 64-bit hash of value from the MD5 of its repr, the same in every process
+       (unlike hash(), which -R randomizes). unicode goes in as UTF-8 and longs as ints.
+    '''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, long):
+        value = int(value)
+    return _UINT64.unpack_from(hashlib.md5(repr(value)).digest())[0]
+
+
+EPOCH = datetime(1970, 1, 1)
+
+def _seconds(value):
+    '''Return a timedelta, datetime, date or number as seconds (since the epoch, for points in time).'''
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, datetime):
+        return (value.replace(tzinfo=None) - EPOCH).total_seconds() - (value.utcoffset() or timedelta(0)).total_seconds()
+    if isinstance(value, date):
+        return (datetime.combine(value, datetime.min.time()) - EPOCH).total_seconds()
+    return float(value)
+
+
+def _subtractTotals(running, pane):
+    '''Take a pane's totals back out of running totals, dropping keys left with no transactions.'''
+    for key, (count, amount) in pane._pairs():
+        total = running._lookup(key)
+        if total is None:
+            continue
+        if total[0] == count:
+            running._discard(key)
+        else:
+            running._store(key, Total(total[0] - count, total[1] - amount))
+
+
+def _totalSortKey(by):
+    '''Return a sort key over Totals, ordering by amount or count and then by the other.'''
+    if by == 'amount':
+        return lambda total: (total[1], total[0])
+    if by == 'count':
+        return lambda total: (total[0], total[1])
+    raise ValueError("by must be 'amount' or 'count', got %r" % (by,))
+
+
+def _groupColumns(columns, count, amount, moments=None):
+    '''Sort rows by their key codes and sum count and amount over equal keys, merging
+       each row's (low, high, m2) moments columns too when given.
+    '''
+    if not len(count):
+        return columns, count, amount, moments
+    if columns:
+        # lexsort takes its primary key last
+        order = numpy.lexsort(columns[::-1])
+        columns = [c[order] for c in columns]
+        count, amount = count[order], amount[order]
+        if moments is not None:
+            moments = [m[order] for m in moments]
+        starts = numpy.zeros(len(order), dtype=bool)
+        starts[0] = True
+        for c in columns:
+            starts[1:] |= c[1:] != c[:-1]
+        starts = numpy.flatnonzero(starts)
+    else:
+        starts = numpy.zeros(1, dtype=numpy.intp)
+    counts, amounts = numpy.add.reduceat(count, starts), numpy.add.reduceat(amount, starts)
+    if moments is not None:
+        low, high, m2 = moments
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # Chan's formula over many parts: each row's m2 plus its count times its mean's squared distance from the group's
+            means = numpy.where(count > 0, amount / count, 0.0)
+            group_means = numpy.repeat(numpy.where(counts > 0, amounts / counts, 0.0), numpy.diff(numpy.append(starts, len(count))))
+        spread = m2 + count * (means - group_means) ** 2
+        moments = [numpy.minimum.reduceat(low, starts), numpy.maximum.reduceat(high, starts), numpy.add.reduceat(spread, starts)]
+    return [c[starts] for c in columns], counts, amounts, moments
+
+
+def getComplexCountFromSqlQuery(query, cursor, keylist, batch_size=10000):
+    SqlMap = collections.Counter()
+    cursor.execute(query)
+    key_slots, value_slots = _cursorSlots(cursor, keylist)
+    getkey, getvalue = _keyGetter(key_slots), operator.itemgetter(value_slots[-1])
+    for rows in _fetchBatches(cursor, batch_size):
+        dict.update(SqlMap, itertools.izip(map(getkey, rows), map(_number, map(getvalue, rows))))
+    return SqlMap
+
+def getSetDictFromSqlQuery(query, cursor, keylist, batch_size=10000):
+    SqlMap = dict()
+    cursor.execute(query)
+    key_slots, value_slots = _cursorSlots(cursor, keylist)
+    getkey, getvalue = _keyGetter(key_slots), operator.itemgetter(value_slots[-1])
+    for rows in _fetchBatches(cursor, batch_size):
+        for key, value in itertools.izip(map(getkey, rows), map(getvalue, rows)):
+            item = set([value]) if type(value) is not set else value
+            if not SqlMap.get(key):
+                SqlMap[key] = item
+            else:
+                SqlMap[key].update(item)
+    return SqlMap
+
+def getDistinctFromSqlQuery(query, cursor, keylist, precision=12, batch_size=10000):
+    '''Like getSetDictFromSqlQuery, but keep a HyperLogLog per key instead of a set, so
+       memory per key is fixed. len() of each sketch estimates the distinct count.
+    '''
+    SqlMap = dict()
+    cursor.execute(query)
+    key_slots, value_slots = _cursorSlots(cursor, keylist)
+    getkey, getvalue = _keyGetter(key_slots), operator.itemgetter(value_slots[-1])
+    get = SqlMap.get
+    for rows in _fetchBatches(cursor, batch_size):
+        for key, value in itertools.izip(map(getkey, rows), map(getvalue, rows)):
+            sketch = get(key)
+            if sketch is None:
+                sketch = SqlMap[key] = HyperLogLog(precision)
+            sketch.add(value)
+    return SqlMap
+
+def getAggregatesFromSqlQuery(query, cursor, keylist, batch_size=10000, params=None):
+    SqlMap = Aggregator(keylist)
+    if params is None:
+        cursor.execute(query)
+    else:
+        cursor.execute(query, params)
+    key_slots, value_slots = _cursorSlots(cursor, keylist)
+    # assume count is followed by amount, always
+    getkey, getcount, getamount = _keyGetter(key_slots), operator.itemgetter(value_slots[0]), operator.itemgetter(value_slots[1])
+    put = SqlMap._put
+    for rows in _fetchBatches(cursor, batch_size):
+        for key, count, amount in itertools.izip(map(getkey, rows), map(getcount, rows), map(getamount, rows)):
+            put(key, Total(int(count), float(amount)))
+    return SqlMap
+
+def getAggregatesFromTable(cursor, source, fieldnames, amount_column='amount', where=None, collapse=(), paramstyle='qmark', batch_size=10000):
+    '''Aggregate in the database with SELECT fields, COUNT(*), SUM(amount) ... GROUP BY, returning an Aggregator.
+
+    :param: source: a table name, or a SELECT statement to use as a subquery.
+    :param: fieldnames: key fields, or an Aggregator whose fields to use.
+    :param: where: mapping of field to a value or tuple of values, as for filter keywords.
+    :param: collapse: fields left out of the grouping, as for collapse.
+    :param: paramstyle: the DB-API paramstyle of the cursor's module.
+    '''
+    fields = tuple(getattr(fieldnames, '_fields', fieldnames))
+    where = where or {}
+    for name in fields + tuple(where) + (amount_column,):
+        _checkIdentifier(name)
+    for field in collapse:
+        fields.index(field)
+    kept = [f for f in fields if f not in collapse]
+    if source.strip().upper().startswith('SELECT'):
+        source = '(%s) AS source' % source
+    else:
+        _checkIdentifier(source)
+    params = {} if paramstyle in ('named', 'pyformat') else []
+    conditions = []
+    for field, values in sorted(where.iteritems()):
+        values = values if isinstance(values, (tuple, list, set, frozenset)) else (values,)
+        marks = []
+        for value in values:
+            marks.append(_placeholder(paramstyle, len(params)))
+            if isinstance(params, dict):
+                params['p%d' % len(params)] = value
+            else:
+                params.append(value)
+        conditions.append('%s IN (%s)' % (field, ', '.join(marks)) if marks else '1 = 0')
+    query = 'SELECT %s FROM %s' % (', '.join(kept + ['COUNT(*)', 'COALESCE(SUM(%s), 0)' % amount_column]), source)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    if kept:
+        query += ' GROUP BY ' + ', '.join(kept)
+    return getAggregatesFromSqlQuery(query, cursor, kept, batch_size, params)
+
+def _checkIdentifier(name):
+    if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$', name):
+        raise ValueError('%r is not a plain SQL identifier' % (name,))
+
+def _placeholder(paramstyle, position):
+    if paramstyle == 'qmark':
+        return '?'
+    if paramstyle == 'format':
+        return '%s'
+    if paramstyle == 'numeric':
+        return ':%d' % (position + 1)
+    if paramstyle == 'named':
+        return ':p%d' % position
+    if paramstyle == 'pyformat':
+        return '%%(p%d)s' % position
+    raise ValueError('unknown paramstyle %r' % (paramstyle,))
+
+def _cursorSlots(cursor, keylist):
+    '''Return the column positions of keylist, and of the remaining values, in an executed cursor's rows.
+
+    Column names come from the DB-API description, falling back to the older
+    fieldnames() method for cursors which have no description.
+    '''
+    if getattr(cursor, 'description', None) is not None:
+        names = [column[0] for column in cursor.description]
+    else:
+        names = list(cursor.fieldnames())
+    key_slots = [names.index(k) for k in keylist]
+    value_slots = [i for i in xrange(len(names)) if i not in key_slots]
+    return key_slots, value_slots
+
+def _fetchBatches(cursor, size):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        if _fetched is not None:
+            _fetched[0] += len(rows)
+        yield rows
+
+def _number(value):
+    return int(value) if type(value) in (int,long) or (type(value) in (str,unicode) and value.isdigit()) else float(value)
+
+
+#################################################
+##                Instrumentation
+#################################################
+
+OpStats = collections.namedtuple('OpStats', ['calls', 'seconds', 'slowest', 'rows', 'keys'])
+
+# (owner, attribute, how rows and keys are counted, position of the input rows).
+# 'ingest' counts input rows and the growth in keys; 'append' counts input rows only,
+# for ColumnarAggregator, where counting keys would run its lazy group-by after every
+# call; 'derive' counts the keys read and the keys of the result; 'sql' counts rows
+# fetched and keys returned. A probed operation called from inside another (as
+# ColumnarAggregator.update_many calls update_columns) is not recorded again.
+_PROBES = [
+    (Aggregator, 'update', 'ingest', 1),
+    (Aggregator, 'update_many', 'ingest', 1),
+    (Aggregator, 'update_columns', 'ingest', 2),
+    (Aggregator, 'filter', 'derive', None),
+    (Aggregator, 'collapse', 'derive', None),
+    (Aggregator, 'merge', 'derive', None),
+    (Aggregator, '__add__', 'derive', None),
+    (ColumnarAggregator, 'update', 'append', 1),
+    (ColumnarAggregator, 'update_many', 'append', 1),
+    (ColumnarAggregator, 'update_columns', 'append', 2),
+    (ColumnarAggregator, 'filter', 'derive', None),
+    (ColumnarAggregator, 'collapse', 'derive', None),
+    (ColumnarAggregator, 'merge', 'derive', None),
+    (ColumnarAggregator, '__add__', 'derive', None),
+    (None, 'getComplexCountFromSqlQuery', 'sql', None),
+    (None, 'getSetDictFromSqlQuery', 'sql', None),
+    (None, 'getDistinctFromSqlQuery', 'sql', None),
+    (None, 'getAggregatesFromSqlQuery', 'sql', None),
+    (None, 'getAggregatesFromTable', 'sql', None),
+]
+
+_originals = {}   # probe name -> the uninstrumented function
+_stats = {}       # probe name -> [calls, seconds, slowest, rows, keys]
+_stats_lock = threading.Lock()
+_nesting = threading.local()  # .active while a probed call runs on this thread
+_exporter = None
+_fetched = None   # [rows fetched by the SQL loaders] while instrumentation is on
+
+def enableInstrumentation(exporter=None):
+    '''Start recording calls, wall time, rows and key growth for the ingest, derive and SQL
+       operations in _PROBES, readable through stats().
+
+    Nothing is wrapped until this is called, so the operations cost nothing extra
+    while instrumentation is off. SQL loaders are swapped in this module's
+    namespace, so names imported from it beforehand stay uninstrumented.
+    ColumnarAggregator ingest records no key growth, since counting its keys
+    would group its pending rows after every call.
+
+    :param: exporter: callable(operation, seconds, rows, keys), called after every
+            recorded call, e.g. to push metrics to a monitoring system.
+    '''
+    global _exporter, _fetched
+    _exporter = exporter
+    if _fetched is None:
+        _fetched = [0]
+    module = globals()
+    for owner, attribute, kind, position in _PROBES:
+        name = attribute if owner is None else '%s.%s' % (owner.__name__, attribute)
+        if name in _originals:
+            continue
+        function = module[attribute] if owner is None else owner.__dict__[attribute]
+        _originals[name] = function
+        probe = _probe(name, function, kind, position)
+        if owner is None:
+            module[attribute] = probe
+        else:
+            setattr(owner, attribute, probe)
+
+def disableInstrumentation():
+    '''Restore the uninstrumented operations. Recorded stats are kept until resetStats().'''
+    global _exporter, _fetched
+    module = globals()
+    for owner, attribute, kind, position in _PROBES:
+        name = attribute if owner is None else '%s.%s' % (owner.__name__, attribute)
+        if name not in _originals:
+            continue
+        if owner is None:
+            module[attribute] = _originals.pop(name)
+        else:
+            setattr(owner, attribute, _originals.pop(name))
+    _exporter = _fetched = None
+
+def stats():
+    '''Return a snapshot of the recorded operations, as a dict of name to OpStats.'''
+    with _stats_lock:
+        return dict((name, OpStats(*record)) for name, record in _stats.iteritems())
+
+def resetStats():
+    with _stats_lock:
+        _stats.clear()
+
+def _record(name, seconds, rows, keys):
+    with _stats_lock:
+        record = _stats.get(name)
+        if record is None:
+            record = _stats[name] = [0, 0.0, 0.0, 0, 0]
+        record[0] += 1
+        record[1] += seconds
+        record[2] = max(record[2], seconds)
+        record[3] += rows
+        record[4] += keys
+    if _exporter is not None:
+        _exporter(name, seconds, rows, keys)
+
+def _counted(rows, tally):
+    '''Yield rows, counting them into tally[0].'''
+    for row in rows:
+        tally[0] += 1
+        yield row
+
+def _probe(name, function, kind, position):
+    '''Wrap function to record each call to it under name.'''
+    clock = timeit.default_timer
+    if kind in ('ingest', 'append'):
+        grows = kind == 'ingest'
+        def probe(self, *args, **kwargs):
+            tally = None
+            if len(args) >= position:
+                rows = args[position - 1]
+                if hasattr(rows, '__len__'):
+                    tally = [len(rows)]
+                else:
+                    tally = [0]
+                    args = args[:position - 1] + (_counted(rows, tally),) + args[position:]
+            before = len(self) if grows else 0
+            start = clock()
+            result = function(self, *args, **kwargs)
+            _record(name, clock() - start, tally[0] if tally else len(kwargs), len(self) - before if grows else 0)
+            return result
+    elif kind == 'derive':
+        def probe(self, *args, **kwargs):
+            rows = len(self) + sum(len(arg) for arg in args if isinstance(arg, (Aggregator, ColumnarAggregator)))
+            start = clock()
+            result = function(self, *args, **kwargs)
+            _record(name, clock() - start, rows, len(result) if hasattr(result, '__len__') else 0)
+            return result
+    else:
+        def probe(*args, **kwargs):
+            fetched = _fetched[:] if _fetched is not None else [0]
+            start = clock()
+            result = function(*args, **kwargs)
+            elapsed = clock() - start
+            _record(name, elapsed, (_fetched[0] if _fetched is not None else 0) - fetched[0], len(result))
+            return result
+    def outermost(*args, **kwargs):
+        if getattr(_nesting, 'active', False):
+            # inside another probed call, which records this work already
+            return function(*args, **kwargs)
+        _nesting.active = True
+        try:
+            return probe(*args, **kwargs)
+        finally:
+            _nesting.active = False
+    return functools.wraps(function)(outermost)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+'''Reproducible timings and peak memory for the Aggregator hot paths and SQL loaders.
+
+Each operation runs in its own forked process, which first builds what the
+operation needs (an Aggregator, a sqlite3 ledger) from a seeded synthetic
+stream, then times the operation alone and reports how far it pushed the
+process's peak resident memory beyond that setup.
+
+Usage:
+    python benchmark.py [--rows 1000000,10000000] [--cardinality demo,100] [--ops update_many,collapse]
+                        [--repeat 3] [--json results.json] [--compare baseline.json] [--tolerance 0.25]
+
+--compare exits with status 1 if any operation is more than --tolerance slower
+(or uses that much more memory) than in the baseline JSON.
+'''
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import Queue
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import aggregator
+
+#################################################
+##                Functions
+#################################################
+
+FIELDS = ['field1', 'field2', 'field3']
+DEMO = (('EUR', 'GBP', 'PLN', 'USD'), ('de', 'es', 'fr', 'it', 'nl', 'pt'), ('pos','atm'))
+CHUNK = 65536
+THREADS = 4   # writer threads for the concurrent operations, set by --threads
+
+def synthesize(n, seed=0, cardinality=None, start=0):
+    '''Return n (ccy, land, method, amount) rows shaped like the aggregator demo.
+
+    :param: cardinality: distinct values per field, or None for the demo's 4 x 6 x 2.
+    :param: start: index of the first row, which scales its amount as in the demo.
+    '''
+    rng = random.Random(seed)
+    if cardinality is None:
+        ccy, land, method = DEMO
+    else:
+        ccy, land, method = [['%s%d' % (f[0], v) for v in xrange(cardinality)] for f in DEMO]
+    return [(rng.choice(ccy), rng.choice(land), rng.choice(method), i * float('%01.2f' % rng.random()))
+            for i in xrange(start, start + n)]
+
+def stream(n, seed=0, cardinality=None, chunk_size=CHUNK):
+    '''Yield the rows of an n-row synthetic ledger in chunks, so 50M rows never sit in memory at once.'''
+    for number, start in enumerate(xrange(0, n, chunk_size)):
+        yield synthesize(min(chunk_size, n - start), hash((seed, number)), cardinality, start)
+
+def sqlite_ledger(rows, path=':memory:'):
+    '''Return a sqlite3 connection holding rows in a ledger(id, field1, field2, field3, amount) table.
+
+    rows may be a list of rows or an iterable of chunks of them.
+    '''
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE ledger (id INTEGER PRIMARY KEY, field1 TEXT, field2 TEXT, field3 TEXT, amount REAL)')
+    chunks = [rows] if isinstance(rows, list) else rows
+    for chunk in chunks:
+        connection.executemany('INSERT INTO ledger (field1, field2, field3, amount) VALUES (?, ?, ?, ?)', chunk)
+    connection.commit()
+    return connection
+
+def fetchall_aggregates(query, cursor, keylist):
+    '''The fetchall()/keylist.index() loader getAggregatesFromSqlQuery used to be, kept for comparison.'''
+    SqlMap = aggregator.Aggregator(keylist)
+    cursor.execute(query)
+    names = [column[0] for column in cursor.description]
+    key_indices = dict( (names.index(k), k) for k in keylist)
+    for row in cursor.fetchall():
+        count, amount = None, None
+        key = keylist[:]
+        for i, value in enumerate(row):
+            if i in key_indices:
+                key[keylist.index(key_indices[i])] = value
+                continue
+            if count:
+                amount = float(value)
+            else:
+                count = int(value)
+        SqlMap[tuple(key)] = aggregator.Total(count, amount)
+    return SqlMap
+
+#################################################
+##                Suite
+#################################################
+
+# Each setup takes (rows, seed, cardinality) and returns the callable to time,
+# whether its work is counted in ledger rows or in keys of the Aggregators it
+# reads, and how many of those there are, optionally followed by a check to run
+# on the outcome once timing is done.
+
+def _built(n, seed, cardinality):
+    agg = aggregator.Aggregator(FIELDS)
+    for chunk in stream(n, seed, cardinality):
+        agg.update_many(chunk)
+    return agg
+
+def _first(agg, field):
+    return next(agg.iterfieldkeys(field))
+
+def setup_update(n, seed, cardinality):
+    def run():
+        agg = aggregator.Aggregator(FIELDS)
+        for chunk in stream(n, seed, cardinality):
+            for f1, f2, f3, amount in chunk:
+                agg.update({(f1, f2, f3): amount})
+    return run, 'rows', n
+
+def setup_setitem(n, seed, cardinality):
+    def run():
+        agg = aggregator.Aggregator(FIELDS)
+        for chunk in stream(n, seed, cardinality):
+            for f1, f2, f3, amount in chunk:
+                agg[(f1, f2, f3)] = amount
+    return run, 'rows', n
+
+def setup_update_many(n, seed, cardinality):
+    return (lambda: _built(n, seed, cardinality)), 'rows', n
+
+def setup_update_columns(n, seed, cardinality):
+    def run():
+        agg = aggregator.Aggregator(FIELDS)
+        for chunk in stream(n, seed, cardinality):
+            columns = zip(*chunk)
+            agg.update_columns(columns[:-1], columns[-1])
+    return run, 'rows', n
+
+def setup_columnar_update_many(n, seed, cardinality):
+    if aggregator.numpy is None:
+        return None, 'rows', n
+    def run():
+        agg = aggregator.ColumnarAggregator(FIELDS)
+        for chunk in stream(n, seed, cardinality):
+            agg.update_many(chunk)
+        len(agg)
+    return run, 'rows', n
+
+def setup_filter(n, seed, cardinality):
+    agg = _built(n, seed, cardinality)
+    value = _first(agg, 'field1')
+    return (lambda: agg.filter(field1=value)), 'keys', len(agg)
+
+def setup_collapse(n, seed, cardinality):
+    agg = _built(n, seed, cardinality)
+    return (lambda: agg.collapse('field2')), 'keys', len(agg)
+
+def setup_merge(n, seed, cardinality):
+    agg = _built(n, seed, cardinality)
+    other = agg.collapse('field3')
+    return (lambda: agg.merge(other)), 'keys', len(agg) + len(other)
+
+def setup_add(n, seed, cardinality):
+    agg = _built(n, seed, cardinality)
+    other = agg.copy()
+    return (lambda: agg + other), 'keys', len(agg) + len(other)
+
+def setup_value_sorted(n, seed, cardinality):
+    agg = _built(n, seed, cardinality)
+    return (lambda: agg.value_sorted()), 'keys', len(agg)
+
+def setup_getcsv(n, seed, cardinality):
+    agg = _built(n, seed, cardinality)
+    return (lambda: agg.getcsv()), 'keys', len(agg)
+
+def _threaded(n, seed, cardinality, write):
+    '''Return a callable which has THREADS writer threads call write(chunk) over their share of the ledger chunks.'''
+    # the rows of _built, pre-generated so only the writes are timed, in smaller chunks so threads interleave
+    chunks = [chunk[start:start + 4096] for chunk in stream(n, seed, cardinality) for start in xrange(0, len(chunk), 4096)]
+    def run():
+        threads = [threading.Thread(target=lambda mine: map(write, mine), args=(chunks[i::THREADS],)) for i in xrange(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return run
+
+def _check_totals(agg, n, seed, cardinality):
+    '''Raise AssertionError unless agg holds exactly the totals of a single-threaded build.'''
+    expected = _built(n, seed, cardinality)
+    if len(agg) != len(expected):
+        raise AssertionError('%d keys written concurrently, %d expected' % (len(agg), len(expected)))
+    for key, total in expected.iteritems():
+        got = agg[key]
+        if got.count != total.count or abs(got.amount - total.amount) > 1e-6 * max(1.0, abs(total.amount)):
+            raise AssertionError('%s: %s written concurrently, %s expected' % (key, got, total))
+
+def setup_locked_update_many(n, seed, cardinality):
+    agg, lock = aggregator.Aggregator(FIELDS), threading.Lock()
+    def write(chunk):
+        with lock:
+            agg.update_many(chunk)
+    return _threaded(n, seed, cardinality, write), 'rows', n
+
+def setup_concurrent_update_many(n, seed, cardinality):
+    agg = aggregator.ConcurrentAggregator(FIELDS)
+    return _threaded(n, seed, cardinality, agg.update_many), 'rows', n, lambda: _check_totals(agg, n, seed, cardinality)
+
+def setup_concurrent_update(n, seed, cardinality):
+    '''Stress test: many threads adding one message at a time to overlapping keys.'''
+    agg = aggregator.ConcurrentAggregator(FIELDS)
+    def write(chunk):
+        for f1, f2, f3, amount in chunk:
+            agg.update({(f1, f2, f3): amount})
+    return _threaded(n, seed, cardinality, write), 'rows', n, lambda: _check_totals(agg, n, seed, cardinality)
+
+def _ledger_cursor(n, seed, cardinality):
+    '''Return a cursor on a sqlite3 ledger file of the synthetic rows, removed once opened.'''
+    fd, path = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+    os.unlink(path)
+    connection = sqlite_ledger(stream(n, seed, cardinality), path)
+    os.unlink(path)  # the open connection keeps the file until the process exits
+    return connection.cursor()
+
+# one result row per ledger row, so the loaders carry the whole table
+ROW_QUERY = 'SELECT id, field1, 1 AS count, amount FROM ledger'
+
+def setup_sql_fetchall(n, seed, cardinality):
+    cursor = _ledger_cursor(n, seed, cardinality)
+    return (lambda: fetchall_aggregates(ROW_QUERY, cursor, ['id', 'field1'])), 'rows', n
+
+def setup_getAggregatesFromSqlQuery(n, seed, cardinality):
+    cursor = _ledger_cursor(n, seed, cardinality)
+    return (lambda: aggregator.getAggregatesFromSqlQuery(ROW_QUERY, cursor, ['id', 'field1'])), 'rows', n
+
+def setup_getComplexCountFromSqlQuery(n, seed, cardinality):
+    cursor = _ledger_cursor(n, seed, cardinality)
+    return (lambda: aggregator.getComplexCountFromSqlQuery(ROW_QUERY, cursor, ['id', 'field1'])), 'rows', n
+
+def setup_getSetDictFromSqlQuery(n, seed, cardinality):
+    cursor = _ledger_cursor(n, seed, cardinality)
+    query = 'SELECT field1, field2, id FROM ledger'
+    return (lambda: aggregator.getSetDictFromSqlQuery(query, cursor, ['field1', 'field2'])), 'rows', n
+
+def setup_getAggregatesFromTable(n, seed, cardinality):
+    cursor = _ledger_cursor(n, seed, cardinality)
+    return (lambda: aggregator.getAggregatesFromTable(cursor, 'ledger', FIELDS)), 'rows', n
+
+OPERATIONS = [
+    ('update', setup_update),
+    ('__setitem__', setup_setitem),
+    ('update_many', setup_update_many),
+    ('update_columns', setup_update_columns),
+    ('columnar_update_many', setup_columnar_update_many),
+    ('locked_update_many', setup_locked_update_many),
+    ('concurrent_update_many', setup_concurrent_update_many),
+    ('concurrent_update', setup_concurrent_update),
+    ('filter', setup_filter),
+    ('collapse', setup_collapse),
+    ('merge', setup_merge),
+    ('__add__', setup_add),
+    ('value_sorted', setup_value_sorted),
+    ('getcsv', setup_getcsv),
+    ('sql_fetchall', setup_sql_fetchall),
+    ('getAggregatesFromSqlQuery', setup_getAggregatesFromSqlQuery),
+    ('getComplexCountFromSqlQuery', setup_getComplexCountFromSqlQuery),
+    ('getSetDictFromSqlQuery', setup_getSetDictFromSqlQuery),
+    ('getAggregatesFromTable', setup_getAggregatesFromTable),
+]
+
+def _peak_kb():
+    # ru_maxrss is in kilobytes on Linux, bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def _measure(setup, n, seed, cardinality, results):
+    try:
+        prepared = setup(n, seed, cardinality)
+        run, unit, size = prepared[:3]
+        if run is None:
+            results.put(None)
+            return
+        baseline = _peak_kb()
+        start = timeit.default_timer()
+        run()
+        elapsed = timeit.default_timer() - start
+        growth = max(_peak_kb() - baseline, 0)
+        if len(prepared) > 3:
+            prepared[3]()
+        results.put((elapsed, baseline, growth, unit, size))
+    except Exception as error:
+        results.put(error)
+        raise
+
+def _outcome(child, results):
+    '''Wait for the child's result, returning its exit code instead if it dies without sending one.'''
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Queue.Empty:
+            if child.is_alive():
+                continue
+        # it may have sent its result just before exiting
+        try:
+            return results.get(timeout=1)
+        except Queue.Empty:
+            child.join()
+            return child.exitcode
+
+def measure(name, setup, n, seed, cardinality, repeat=1):
+    '''Run one operation repeat times, each in a fresh process, returning a result record (or None if unavailable).
+
+    The fastest run's time is kept, along with the largest peak memory growth. A
+    child which dies without reporting (killed for running out of memory, say)
+    gives a record with the reason under 'failed' instead of timings.
+    '''
+    record = {'operation': name, 'rows': n, 'cardinality': cardinality or 'demo'}
+    runs = []
+    for attempt in xrange(repeat):
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_measure, args=(setup, n, seed, cardinality, results))
+        child.start()
+        outcome = _outcome(child, results)
+        child.join()
+        if outcome is None:
+            return None
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, int):
+            record['failed'] = 'killed by signal %d' % -outcome if outcome < 0 else 'exited with code %d' % outcome
+            return record
+        runs.append(outcome)
+    elapsed = min(run[0] for run in runs)
+    unit, size = runs[0][3:5]
+    record.update({
+        'seconds': round(elapsed, 6),
+        # key-level operations read keys, not ledger rows, so their rate is per key
+        unit + '_per_sec': round(size / elapsed, 1) if elapsed else None,
+        'works_on': unit,
+        'setup_peak_kb': max(run[1] for run in runs),
+        'peak_growth_kb': max(run[2] for run in runs),
+        'repeat': repeat,
+        'threads': THREADS if name.startswith(('locked_', 'concurrent_')) else 1,
+    })
+    if unit == 'keys':
+        record['keys'] = size
+    return record
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'numpy': getattr(aggregator.numpy, '__version__', None),
+        'sqlite': sqlite3.sqlite_version,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+def compare(results, baseline, tolerance):
+    '''Print each result against the matching baseline record, returning those which regressed.'''
+    previous = dict(((r['operation'], r['rows'], r['cardinality']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        before = previous.get((result['operation'], result['rows'], result['cardinality']))
+        if before is None or 'failed' in before:
+            continue
+        if 'failed' in result:
+            print('%-30s %10s %6s  %s  REGRESSION' % (result['operation'], result['rows'], result['cardinality'], result['failed']))
+            regressions.append(result)
+            continue
+        speed = result['seconds'] / before['seconds'] if before['seconds'] else 1.0
+        memory = (float(result['peak_growth_kb']) + 1024) / (before['peak_growth_kb'] + 1024)  # ignore sub-MB noise
+        flag = speed > 1 + tolerance or memory > 1 + tolerance
+        print('%-30s %10s %6s  time x%.2f  memory x%.2f%s' % (result['operation'], result['rows'], result['cardinality'],
+                                                           speed, memory, '  REGRESSION' if flag else ''))
+        if flag:
+            regressions.append(result)
+    return regressions
+
+def _cardinality(value):
+    return None if value == 'demo' else int(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory-profile Aggregator operations.')
+    parser.add_argument('rows', nargs='?', type=int, help='shorthand for --rows with a single size')
+    parser.add_argument('--rows', dest='sizes', default='1000000', help='comma-separated ledger sizes, e.g. 1000000,10000000,50000000')
+    parser.add_argument('--cardinality', default='demo,100', help="comma-separated distinct values per field; 'demo' is 4 x 6 x 2")
+    parser.add_argument('--ops', default=','.join(name for name, setup in OPERATIONS), help='comma-separated operations to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=THREADS, help='writer threads for the concurrent operations')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per operation; the fastest is kept')
+    parser.add_argument('--json', help="write results as JSON to this path ('-' for stdout)")
+    parser.add_argument('--compare', help='baseline JSON to compare results against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown or memory growth against the baseline')
+    args = parser.parse_args()
+    THREADS = args.threads
+
+    sizes = [args.rows] if args.rows else [int(size) for size in args.sizes.split(',')]
+    cardinalities = [_cardinality(c) for c in args.cardinality.split(',')]
+    setups = dict(OPERATIONS)
+    wanted = args.ops.split(',')
+    for name in wanted:
+        if name not in setups:
+            parser.error('unknown operation %r; choose from %s' % (name, ', '.join(setups)))
+
+    results = []
+    for n, cardinality in itertools.product(sizes, cardinalities):
+        print('%d rows, %s cardinality, %d fields' % (n, cardinality or 'demo', len(FIELDS)))
+        for name in wanted:
+            result = measure(name, setups[name], n, args.seed, cardinality, args.repeat)
+            if result is None:
+                print('  %-36s unavailable' % name)
+                continue
+            results.append(result)
+            if 'failed' in result:
+                print('  %-36s failed: %s' % (name, result['failed']))
+                continue
+            unit = result['works_on']
+            print('  %-36s %9.3fs %12.0f %4s/sec %10d KB peak growth' % (name, result['seconds'], result[unit + '_per_sec'] or 0,
+                                                                       unit, result['peak_growth_kb']))
+
+    report = {'environment': environment(), 'seed': args.seed, 'results': results}
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    elif args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fd:
+            regressions = compare(results, json.load(fd), args.tolerance)
+        sys.exit(1 if regressions else 0)